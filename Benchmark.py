@@ -0,0 +1,299 @@
+#!/usr/bin/python
+##################################################
+#
+# Filename: Benchmark.py
+# Description: Benchmark of TheCoreRemapper on the real seeds and on synthetic
+#              fixtures: commands and conflict cards, layouts or seeds scaled.
+# Usage: python Benchmark.py [--scale N ...] [--axis commands|layouts|seeds ...]
+#                            [--repeat N] [--json FILE] [--compare FILE]
+#
+# Every fixture is built in a temporary directory, the stages (create_model,
+# generate, the layout writes, modify_value, getConstraints, each check) are
+# timed with the stage instrumentation of TheCoreRemapper, best of --repeat runs.
+# The growth column is the exponent of the time against the measured size of
+# the work of the stage (1 ~ linear, 2 ~ quadratic), compared to the real seeds:
+# commands x generated files for the generation, commands x seeds otherwise.
+#
+##################################################
+import argparse
+import collections
+import contextlib
+import io
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import TheCoreRemapper as T
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+ini_files = ['MapDefinitions.ini', 'KeyboardLayouts.ini', 'Defaults.ini', 'DifferentDefault.ini', 'Inheritance.ini']
+## sections scaled by the commands axis, and the files in which the values are command names
+command_sections = ['Commands']
+command_valued_files = ['Inheritance.ini']
+AXES = ['commands', 'layouts', 'seeds']
+## stages whose work grows with the generated files
+FILE_STAGES = ['generate', 'write (all layouts)']
+## the seeds axis can only add the race seeds to the real one
+SEEDS_SCALE = 1 + len(T.Races)
+## conflict cards of the repository, set by main()
+real_conflict_checks = None
+
+####################################################################################
+## Fixtures
+####################################################################################
+
+def read_dict(filepath):
+	parser = T.ConfigParser()
+	parser.read(filepath)
+	return {section: dict(parser.items(section, raw=True)) for section in parser.sections()}
+
+def write_dict(model, filepath):
+	parser = T.ConfigParser(interpolation=None)
+	parser.read_dict(model)
+	with open(filepath, 'w') as myfile:
+		parser.write(myfile)
+
+def copy_name(name, index):
+	"""Name of the index-th synthetic copy of a command, conflict card or layout."""
+	if index == 0:
+		return name
+	return name + "_B" + str(index)
+
+def scale_commands(model, scale, command_valued=False):
+	for section in command_sections:
+		if not section in model:
+			continue
+		scaled = {}
+		for key, value in model[section].items():
+			for index in range(scale):
+				scaled[copy_name(key, index)] = copy_name(value, index) if command_valued else value
+		model[section] = scaled
+	return model
+
+def scale_conflict_checks(scale):
+	conflict_checks = {}
+	for card, commands in real_conflict_checks.items():
+		for index in range(scale):
+			conflict_checks[copy_name(card, index)] = [copy_name(command, index) for command in commands]
+	return conflict_checks
+
+def seed_files():
+	"""Seed files of the repository, relative to it."""
+	filepaths = []
+	for seed in T.OtherSeeds:
+		filepaths.append(seed.value + T.suffix)
+	for race in T.Races:
+		filepaths.append(T.prefix + T.thecore_tag(race, T.Sides.Left, T.Sizes.Medium) + T.suffix)
+	return [filepath for filepath in filepaths if os.path.isfile(os.path.join(root_dir, filepath))]
+
+def build_fixture(directory, axis=None, scale=1):
+	"""Write the inputs of the remapper in directory, scaled along an axis."""
+	command_scale = scale if axis == 'commands' else 1
+	layout_scale = scale if axis == 'layouts' else 1
+	seeds = seed_files()
+	os.makedirs(os.path.join(directory, 'stable'))
+	for filepath in ini_files + seeds + [os.path.join('stable', seed) for seed in seeds]:
+		source = os.path.join(root_dir, filepath)
+		if not os.path.isfile(source):
+			continue
+		model = read_dict(source)
+		if filepath == 'KeyboardLayouts.ini':
+			model = {copy_name(layout, index): keys for layout, keys in model.items() for index in range(layout_scale)}
+		elif filepath != 'MapDefinitions.ini':
+			model = scale_commands(model, command_scale, filepath in command_valued_files)
+		write_dict(model, os.path.join(directory, filepath))
+	if axis == 'seeds':
+		## the race seeds are copies of the first seed
+		for race in T.Races:
+			filename = T.prefix + T.thecore_tag(race, T.Sides.Left, T.Sizes.Medium) + T.suffix
+			for folder in ['', 'stable']:
+				if not os.path.isfile(os.path.join(directory, folder, filename)):
+					shutil.copyfile(os.path.join(directory, folder, seeds[0]), os.path.join(directory, folder, filename))
+	with open(os.path.join(directory, 'ConflictChecks.py'), 'w') as myfile:
+		myfile.write("# This file is generated by a script. DO NOT edit.\n\nCONFLICT_CHECKS = " + repr(scale_conflict_checks(command_scale)) + "\n")
+
+def use_fixture(directory):
+	"""Point TheCoreRemapper to the fixture: working directory and caches."""
+	os.chdir(directory)
+	T.conflict_checks_filepath = os.path.join(directory, 'ConflictChecks.py')
+	T.conflict_cache_filepath = os.path.join(directory, '.ConflictChecks.cache')
+	T.conflict_table = None
+	T.conflict_checks = None
+	T.ini_cache_filepath = os.path.join(directory, '.IniCache.cache')
+	T.ini_cache = None
+	T.check_cache_dir = directory
+	T.constraints_cache_filepath = os.path.join(directory, '.Constraints.cache')
+
+####################################################################################
+## Runs
+####################################################################################
+
+def bench_modify_value(model, seeds):
+	"""modify_value() on every value of the model, for the first translated layout."""
+	layouts = [layout for layout in T.layout_parser.sections() if layout != T.seed_layout]
+	if not layouts:
+		return
+	key_map = T.variant_key_map(T.Sides.Left, T.Sizes.Medium, layouts[0])
+	for section in model.values():
+		for hotkey in section.values():
+			for seed in seeds:
+				T.modify_value(hotkey.get_value(seed), key_map)
+
+def run_once():
+	"""One run of the remapper in the working directory, stats of the stages.
+	The check results and constraints caches are removed first, so that every
+	run evaluates the checks."""
+	T.stage_stats.clear()
+	for filename in os.listdir('.'):
+		if filename.startswith('.CheckResults-') or filename == '.Constraints.cache':
+			os.remove(filename)
+	with contextlib.redirect_stdout(io.StringIO()):
+		T.load_config()
+		seeds = T.select_seeds()
+		model = T.create_model(seeds)
+		T.generate(seeds, model, force=True)
+		with T.stage("modify_value"):
+			bench_modify_value(model, seeds)
+		with T.stage("getConstraints"):
+			T.constraints = T.getConstraints()
+		T.analyse(model, list(T.CHECKS))
+	stats = collections.OrderedDict()
+	for name, stage_stats in T.stage_stats.items():
+		## the layout writes are summed up, their number grows with the layouts
+		if name.startswith("write "):
+			name = "write (all layouts)"
+		if not name in stats:
+			stats[name] = {"wall": 0.0, "calls": 0}
+		stats[name]["wall"] += stage_stats["wall"]
+		stats[name]["calls"] += stage_stats["calls"]
+	size = collections.OrderedDict()
+	size["commands"] = len(model.get('Commands', {}))
+	size["conflict cards"] = len(T.get_conflict_checks())
+	size["seeds"] = len(seeds)
+	size["layouts"] = len(T.layout_parser.sections())
+	size["files"] = sum(1 for seed in seeds for output in T.seed_outputs(seed))
+	return size, stats
+
+def run_fixture(axis, scale, repeat, keep=False):
+	directory = tempfile.mkdtemp(prefix="TheCoreBenchmark")
+	cwd = os.getcwd()
+	try:
+		build_fixture(directory, axis, scale)
+		use_fixture(directory)
+		best = collections.OrderedDict()
+		for _ in range(repeat):
+			size, stats = run_once()
+			for name, stage_stats in stats.items():
+				if not name in best or stage_stats["wall"] < best[name]["wall"]:
+					best[name] = stage_stats
+		return {"axis": axis, "scale": scale, "size": size, "stages": best}
+	finally:
+		os.chdir(cwd)
+		if keep:
+			print("fixture kept in " + directory)
+		else:
+			shutil.rmtree(directory, ignore_errors=True)
+
+def fixture_name(axis, scale):
+	if axis is None:
+		return "real seeds"
+	return axis + " x" + str(scale)
+
+####################################################################################
+## Report
+####################################################################################
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_dir, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def work_size(stage_name, size):
+	if stage_name in FILE_STAGES:
+		return size["commands"] * size["files"]
+	return size["commands"] * size["seeds"]
+
+def growth(stage_name, wall, base_wall, size, base_size):
+	"""Exponent of the wall time against the size of the work of the stage."""
+	ratio = work_size(stage_name, size) / work_size(stage_name, base_size)
+	if ratio <= 1 or wall <= 0 or base_wall <= 0:
+		return ""
+	return "%.2f" % (math.log(wall / base_wall) / math.log(ratio))
+
+def print_fixture(name, result, base, previous, threshold):
+	print("== " + name + ": " + ", ".join(str(value) + " " + key for key, value in result["size"].items()))
+	print("%-32s %6s %10s %7s %9s" % ("stage", "calls", "wall (ms)", "growth", "vs ref"))
+	for stage_name, stats in result["stages"].items():
+		base_wall = base["stages"].get(stage_name, {"wall": 0.0})["wall"] if base else 0.0
+		base_size = base["size"] if base else result["size"]
+		compared = ""
+		if previous and stage_name in previous["stages"] and previous["stages"][stage_name]["wall"] > 0:
+			ratio = stats["wall"] / previous["stages"][stage_name]["wall"]
+			compared = "%.2fx" % ratio
+			if ratio > threshold:
+				compared += " !"
+		print("%-32s %6d %10.1f %7s %9s" % (stage_name, stats["calls"], stats["wall"] * 1000, growth(stage_name, stats["wall"], base_wall, result["size"], base_size), compared))
+	print("")
+
+def main(argv=None):
+	global real_conflict_checks
+	arg_parser = argparse.ArgumentParser(description="Benchmark TheCoreRemapper on the real seeds and on scaled synthetic fixtures.")
+	arg_parser.add_argument("--scale", type=int, nargs="+", default=[10], help="scale factors of the synthetic fixtures (default: 10, add 100 for the large fixtures)")
+	arg_parser.add_argument("--axis", nargs="+", choices=AXES, default=AXES, help="what the fixtures scale (default: all); seeds are at most the real seed and the %d races" % len(T.Races))
+	arg_parser.add_argument("--repeat", type=int, default=3, help="runs per fixture, the best one is kept (default: 3)")
+	arg_parser.add_argument("--json", metavar="FILE", help="write the results as JSON")
+	arg_parser.add_argument("--compare", metavar="FILE", help="JSON results of an earlier run to compare with")
+	arg_parser.add_argument("--threshold", type=float, default=1.25, help="ratio to the compared run flagged as a regression (default: 1.25)")
+	arg_parser.add_argument("--keep", action="store_true", help="keep the fixture directories")
+	args = arg_parser.parse_args(argv)
+
+	previous = {}
+	if args.compare:
+		with open(args.compare) as myfile:
+			previous = json.load(myfile)["fixtures"]
+
+	## the real seeds give prefix and suffix of the seed files, and the conflict cards
+	cwd = os.getcwd()
+	os.chdir(root_dir)
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			T.load_config()
+			real_conflict_checks = T.get_conflict_checks()
+	finally:
+		os.chdir(cwd)
+
+	fixtures = [(None, 1)]
+	for axis in args.axis:
+		if axis == 'seeds':
+			fixtures.append((axis, SEEDS_SCALE))
+			continue
+		for scale in args.scale:
+			fixtures.append((axis, scale))
+
+	report = collections.OrderedDict()
+	report["commit"] = git_commit()
+	report["python"] = sys.version.split()[0]
+	report["platform"] = sys.platform
+	report["repeat"] = args.repeat
+	report["fixtures"] = collections.OrderedDict()
+	base = None
+	for axis, scale in fixtures:
+		name = fixture_name(axis, scale)
+		result = run_fixture(axis, scale, args.repeat, args.keep)
+		if axis is None:
+			base = result
+		report["fixtures"][name] = result
+		print_fixture(name, result, base, previous.get(name), args.threshold)
+
+	if args.json:
+		with open(args.json, 'w') as myfile:
+			json.dump(report, myfile, indent=2)
+			myfile.write("\n")
+
+if __name__ == "__main__":
+	main()
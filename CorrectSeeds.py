@@ -69,6 +69,7 @@ class Hotkey:
         self.R = R
         self.default = default
         self.copyOf = copyOf
+        self.root = None
 
     def set_value(self, race, value):
         if race == PROTOSS:
@@ -211,11 +212,27 @@ def correct_seeds(model):
     
 
 def resolve_copyof(model, section, hotkey):
-    while True:
-        if hotkey.copyOf:
-            hotkey = model[section][hotkey.copyOf]
-        else:
-            return hotkey
+    if hotkey.root is None:
+        link_inheritance(model)
+    return hotkey.root
+
+def link_inheritance(model):
+    # set hotkey.root to the end of its copyOf chain, each chain walked once
+    for section in model:
+        for hotkey in model[section].values():
+            path = []
+            names = set()
+            while hotkey.root is None and hotkey.copyOf:
+                if hotkey.name in names:
+                    cycle = [linked.name for linked in path[path.index(hotkey):]]
+                    raise ValueError("copyOf cycle in section " + section + ": " + " -> ".join(cycle + [hotkey.name]))
+                path.append(hotkey)
+                names.add(hotkey.name)
+                hotkey = model[section][hotkey.copyOf]
+            if hotkey.root is None:
+                hotkey.root = hotkey
+            for linked in path:
+                linked.root = hotkey.root
 
 
 init_seed_hotkeyfile_parser()
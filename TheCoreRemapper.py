@@ -4,17 +4,37 @@
 # Filename: TheCoreRemapper.py
 # Author: Jonny Weiss, Mark Rösler
 # Description: Script to take the LM layouts of TheCore and generate the other 44 layouts.
+# Usage: python TheCoreRemapper.py [--jobs N] [--force] [--timing] [--profile DIR] [--report FILE] [all|defaults|generate|analyse|watch]
+#        or import it: load_config(), create_model(), generate(), analyse()
 # Change Log:
 #   9/25/12 - Created
 #   9/26/12 - Finished initial functionality
 #
 ##################################################
 from enum import Enum
+import argparse
+import ast
 import collections  # @UnusedImport
+import cProfile
+import concurrent.futures
 import configparser
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import marshal
 import os  # @UnusedImport
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+	import resource
+except ImportError:  # not available on Windows
+	resource = None
 
-from ConflictChecks import *  # @UnresolvedImport @UnusedWildImport
 from SameChecks import *  # @UnresolvedImport @UnusedWildImport
 
 class ConfigParser(configparser.ConfigParser):
@@ -54,35 +74,400 @@ class OtherSeeds(Enum):
 	LiteRehab = "TheCore LiteRehab"
 	LitePlus = "TheCore LitePlus"
 
+####################################################################################
+## Incremental generation: bump GENERATOR_VERSION whenever a change in this script
+## changes the generated files, so that they all get rebuilt
+####################################################################################
+GENERATOR_VERSION = "1"
+manifest_filepath = '.TheCoreManifest.json'
+
+####################################################################################
+## Conflict table: CONFLICT_CHECKS of ConflictChecks.py is compiled into a marshal
+## cache (command names stored once, cards as command ids), loaded on first use
+## and rebuilt whenever the hash of ConflictChecks.py changes
+####################################################################################
+CONFLICT_CACHE_VERSION = 1
+conflict_checks_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ConflictChecks.py')
+conflict_cache_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.ConflictChecks.cache')
+conflict_table = None
+## sha1 of the ConflictChecks.py the loaded conflict table was built from
+conflict_table_hash = None
+conflict_checks = None
+
+def get_conflict_table():
+	"""(command names, cards) of ConflictChecks.py, cards being (card name,
+	tuple of command ids), the id of a command being its index in command names."""
+	global conflict_table, conflict_table_hash
+	if conflict_table is None:
+		table = load_conflict_table()
+		conflict_table = ([sys.intern(command) for command in table[2]], table[3])
+		conflict_table_hash = table[1]
+	return conflict_table
+
+def refresh_conflict_table():
+	"""Forget the loaded conflict table if ConflictChecks.py changed since."""
+	global conflict_table, conflict_table_hash, conflict_checks
+	if conflict_table is not None and conflict_source_hash() != conflict_table_hash:
+		conflict_table = None
+		conflict_table_hash = None
+		conflict_checks = None
+
+def conflict_source_hash():
+	with open(conflict_checks_filepath, 'rb') as myfile:
+		return hashlib.sha1(myfile.read()).hexdigest()
+
+def get_conflict_checks():
+	"""CONFLICT_CHECKS: conflict card -> list of commands."""
+	global conflict_checks
+	if conflict_checks is None:
+		commands, cards = get_conflict_table()
+		conflict_checks = {}
+		for card, command_ids in cards:
+			conflict_checks[card] = [commands[command_id] for command_id in command_ids]
+	return conflict_checks
+
+def load_cache(filepath, version):
+	"""Tuple of a marshal cache whose first item is version, None when the
+	file is missing, broken or of another version."""
+	try:
+		with open(filepath, 'rb') as myfile:
+			cache = marshal.loads(myfile.read())
+		if cache[0] == version:
+			return cache
+	except (OSError, EOFError, ValueError, TypeError, IndexError):
+		pass
+	return None
+
+def save_cache(filepath, cache):
+	"""Write a marshal cache through a temporary file and a rename, so that a
+	reader never sees a partly written cache."""
+	try:
+		tmp_filepath = filepath + "." + str(os.getpid()) + ".tmp"
+		with open(tmp_filepath, 'wb') as myfile:
+			marshal.dump(cache, myfile)
+		os.replace(tmp_filepath, filepath)
+	except OSError:
+		print("could not write " + filepath)
+
+def load_conflict_table():
+	source_hash = conflict_source_hash()
+	table = load_cache(conflict_cache_filepath, CONFLICT_CACHE_VERSION)
+	if table is not None and table[1] == source_hash:
+		return table
+	return write_conflict_cache()
+
+def build_conflict_table():
+	"""(version, source hash, command names, cards) out of ConflictChecks.py,
+	cards being (card name, command ids) in the order of the source."""
+	with open(conflict_checks_filepath, 'rb') as myfile:
+		source = myfile.read()
+	conflict_checks = None
+	for node in ast.parse(source, conflict_checks_filepath).body:
+		if isinstance(node, ast.Assign) and [getattr(target, 'id', None) for target in node.targets] == ['CONFLICT_CHECKS']:
+			conflict_checks = ast.literal_eval(node.value)
+	if conflict_checks is None:
+		raise ValueError("no CONFLICT_CHECKS in " + conflict_checks_filepath)
+	commands = sorted(set(command for card in conflict_checks.values() for command in card))
+	command_ids = {command: index for index, command in enumerate(commands)}
+	cards = tuple((card, tuple(command_ids[command] for command in conflict_checks[card])) for card in conflict_checks)
+	return (CONFLICT_CACHE_VERSION, hashlib.sha1(source).hexdigest(), tuple(commands), cards)
+
+def write_conflict_cache():
+	table = build_conflict_table()
+	save_cache(conflict_cache_filepath, table)
+	return table
+
+####################################################################################
+## Parsed ini cache
+####################################################################################
+
+INI_CACHE_VERSION = 1
+ini_cache_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.IniCache.cache')
+ini_cache = None
+
+def read_ini(parser, filepath):
+	"""parser.read(filepath), going through the parsed ini cache: the
+	section -> key -> value data of a file is kept on disk together with its
+	mtime, size and sha1, and fed to the parser with read_dict() as long as
+	the file has not changed. Like read(), a missing file is ignored."""
+	try:
+		stat = os.stat(filepath)
+	except OSError:
+		return parser.read(filepath)
+	cache = get_ini_cache()
+	key = os.path.abspath(filepath)
+	entry = cache.get(key)
+	if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+		parser.read_dict(entry[3], source=filepath)
+		return [filepath]
+	with open(filepath) as myfile:
+		text = myfile.read()
+	text_hash = hashlib.sha1(text.encode()).hexdigest()
+	if entry is not None and entry[1] == stat.st_size and entry[2] == text_hash:
+		data = entry[3]
+	else:
+		file_parser = ConfigParser()
+		file_parser.read_string(text, source=filepath)
+		data = {section: dict(file_parser.items(section, raw=True)) for section in file_parser.sections()}
+	cache[key] = (stat.st_mtime_ns, stat.st_size, text_hash, data)
+	save_ini_cache()
+	parser.read_dict(data, source=filepath)
+	return [filepath]
+
+def get_ini_cache():
+	global ini_cache
+	if ini_cache is None:
+		cache = load_cache(ini_cache_filepath, INI_CACHE_VERSION)
+		ini_cache = cache[1] if cache is not None else {}
+	return ini_cache
+
+def save_ini_cache():
+	save_cache(ini_cache_filepath, (INI_CACHE_VERSION, ini_cache))
+
+####################################################################################
+## Timing and profiling of the stages of a run
+####################################################################################
+
+## stage name -> calls, wall time, files written and peak RSS, in order of first use
+stage_stats = collections.OrderedDict()
+stage_stack = []
+## with a directory, the outermost stages are profiled and dumped as <stage>.prof
+profile_dir = None
+profiles = {}
+
+def get_stage_stats(name):
+	if not name in stage_stats:
+		stage_stats[name] = {"calls": 0, "wall": 0.0, "files": 0, "peak_rss_kb": None}
+	return stage_stats[name]
+
+@contextlib.contextmanager
+def stage(name):
+	"""Time a stage of the run, profile it if profile_dir is set and no outer
+	stage is profiled already."""
+	get_stage_stats(name)
+	profiler = None
+	if profile_dir is not None and not stage_stack:
+		profiler = profiles.setdefault(name, cProfile.Profile())
+		profiler.enable()
+	stage_stack.append(name)
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		wall = time.perf_counter() - start
+		stage_stack.pop()
+		if profiler is not None:
+			profiler.disable()
+		record_stage(name, wall)
+
+def record_stage(name, wall, calls=1, files=0):
+	"""Add calls of a stage, possibly measured in another process."""
+	stats = get_stage_stats(name)
+	stats["calls"] += calls
+	stats["wall"] += wall
+	stats["peak_rss_kb"] = peak_rss_kb()
+	if files:
+		stats["files"] += files
+		count_written(files)
+
+def timed(name):
+	"""Decorator running a function as a stage."""
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with stage(name):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def timed_call(name, function, *args):
+	"""Call function as a stage of its own, return (result, stats of the stage);
+	used to bring the timing of work done by a worker process back."""
+	stage_stats.pop(name, None)
+	with stage(name):
+		result = function(*args)
+	return result, stage_stats.pop(name)
+
+def merge_stage(name, stats):
+	record_stage(name, stats["wall"], stats["calls"], stats["files"])
+
+def count_written(files=1):
+	"""Count written files in the running stages."""
+	for name in stage_stack:
+		stage_stats[name]["files"] += files
+
+def peak_rss_kb():
+	"""Peak resident set size of the process and its waited children in kB,
+	None without the resource module."""
+	if resource is None:
+		return None
+	peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	if sys.platform == "darwin":
+		peak //= 1024
+	return peak
+
+def dump_profiles():
+	for name, profiler in profiles.items():
+		profiler.dump_stats(os.path.join(profile_dir, name.replace(" ", "_") + ".prof"))
+	profiles.clear()
+
+def stage_summary():
+	"""Table of the stages: calls, wall time, files written and peak RSS."""
+	lines = ["%-40s %6s %10s %6s %14s" % ("stage", "calls", "wall (s)", "files", "peak RSS (MB)")]
+	for name, stats in stage_stats.items():
+		rss = "-" if stats["peak_rss_kb"] is None else "%.1f" % (stats["peak_rss_kb"] / 1024)
+		lines.append("%-40s %6d %10.3f %6d %14s" % (name, stats["calls"], stats["wall"], stats["files"], rss))
+	return "\n".join(lines)
+
+def write_stage_report(filepath, total_wall):
+	"""JSON report of the stages, to compare runs across releases."""
+	report = collections.OrderedDict()
+	report["generator_version"] = GENERATOR_VERSION
+	report["python"] = sys.version.split()[0]
+	report["platform"] = sys.platform
+	report["total_wall"] = total_wall
+	report["peak_rss_kb"] = peak_rss_kb()
+	report["stages"] = [dict(name=name, **stats) for name, stats in stage_stats.items()]
+	with open(filepath, 'w') as myfile:
+		json.dump(report, myfile, indent=2)
+		myfile.write("\n")
+
 ####################################################################################
 ## Debug infrastructure
 ####################################################################################
 
-debug_parser = ConfigParser(allow_no_value=True)
+debug_parser = ConfigParser()
 debug = False
-try:
-	debug_parser.read('Debug.ini')
-except:
-	print("no Debug.ini file")
 
-debug = debug_parser.getboolean("Settings","debug",fallback=False)
-if not(debug):
-	debug_parser = ConfigParser()
+def load_debug(filepath='Debug.ini'):
+	global debug_parser, debug
+	debug_parser = ConfigParser(allow_no_value=True)
+	try:
+		debug_parser.read(filepath)
+	except:
+		print("no Debug.ini file")
 
+	debug = debug_parser.getboolean("Settings","debug",fallback=False)
+	if not(debug):
+		debug_parser = ConfigParser()
 
 ####################################################################################
+## Configuration, set by load_config() from the .ini files of the working directory
+####################################################################################
+
+default_filepath = 'Defaults.ini'
+ddefault_filepath = 'DifferentDefault.ini'
+inherit_filepath = 'Inheritance.ini'
 
+settings_parser = None
+layout_parser = None
+default_parser = None
+ddefault_parser = None
+inherit_parser = None
+settings_maps = None
+layout_maps = None
+prefix = None
+suffix = None
+seed_layout = None
+hotkeyfile_parsers = None
+allSeeds = None
+constraints = None
+
+@timed("load_config")
+def load_config():
+	"""Read Debug.ini, the mapping and default .ini files and the seed layouts."""
+	global settings_parser, prefix, suffix, seed_layout, layout_parser, settings_maps, layout_maps
+	global default_parser, ddefault_parser, inherit_parser, hotkeyfile_parsers, allSeeds, constraints
+	load_debug()
+
+	# Read the settings
+	settings_parser = ConfigParser()
+	read_ini(settings_parser, 'MapDefinitions.ini')
+	prefix = settings_parser.get("Filenames", "Prefix")
+	suffix = settings_parser.get("Filenames", "Suffix")
+	seed_layout = settings_parser.get("Filenames", "Seed_files_folder")
+
+	layout_parser = ConfigParser()
+	read_ini(layout_parser, 'KeyboardLayouts.ini')
+
+	## plain dict lookups for the translation inner loop
+	settings_maps = compile_maps(settings_parser)
+	layout_maps = compile_maps(layout_parser)
+
+	default_parser = ConfigParser()
+	read_ini(default_parser, default_filepath)
+
+	ddefault_parser = ConfigParser()
+	read_ini(ddefault_parser, ddefault_filepath)
+
+	inherit_parser = ConfigParser()
+	read_ini(inherit_parser, inherit_filepath)
+
+	## Consider all existing seeds for defaults handling/checks
+	hotkeyfile_parsers, allSeeds = init_seed_hotkeyfile_parser()
+	refresh_conflict_table()
+	constraints = None
+
+def update_defaults():
+	"""Add the keys found in the seed layouts to Defaults.ini, then check the defaults."""
+	global default_parser
+	if debug_parser.getboolean("Settings","update_default",fallback=True):
+		default_parser = new_keys_from_seed_hotkeys(default_parser,hotkeyfile_parsers)
+	check_defaults(default_parser)
+
+def select_seeds():
+	"""Possibly reduce the seed list to be considered to the one of Debug.ini."""
+	global allSeeds
+	if not(debug_parser.getboolean("Settings","allseeds",fallback=True)):
+		allSeeds = []
+		for race in debug_parser.options("Races"):
+			allSeeds.append(Races[race])
+		for seed in debug_parser.options("OtherSeeds"):
+			allSeeds.append(OtherSeeds[seed])
+	return allSeeds
+
+####################################################################################
+
+
+## Logger streams to its log file: the messages of the first level of log_file
+## are written as they come, the other levels are spooled (in memory while
+## small, on disk beyond LOG_SPOOL_SIZE) and appended by finish(), so the log
+## keeps its level order. The log is written to a temporary file renamed by
+## finish(), so a check that fails leaves the previous log in place. With
+## jsonlog=1 in Debug.ini, the log is written as JSON lines (.jsonl) in the
+## order of the messages.
+LOG_SPOOL_SIZE = 1 << 20
+LOG_BUFFER_SIZE = 1 << 16
+## loggers whose log file is not finished yet
+open_loggers = []
 
 class Logger:
-	def __init__(self, title, filepath=None, log_file=[LogLevel.Warn, LogLevel.Error], log_consol=[LogLevel.Info, LogLevel.Error]):
+	def __init__(self, title, filepath=None, log_file=[LogLevel.Warn, LogLevel.Error], log_consol=[LogLevel.Info, LogLevel.Error], structured=None):
 		self.title = title
+		if structured is None:
+			structured = debug_parser.getboolean("Settings","jsonlog",fallback=False)
+		self.structured = structured
+		if structured and not filepath is None:
+			filepath = os.path.splitext(filepath)[0] + ".jsonl"
 		self.filepath = filepath
 		self.log_file = log_file
 		self.log_consol = log_consol
-		self.messages = {}
-		self.messages[LogLevel.Info] = []
-		self.messages[LogLevel.Warn] = []
-		self.messages[LogLevel.Error] = []
+		self.counts = {}
+		self.counts[LogLevel.Info] = 0
+		self.counts[LogLevel.Warn] = 0
+		self.counts[LogLevel.Error] = 0
+		self.file = None
+		self.tmp_filepath = None
+		self.spools = {}
+		if not self.filepath is None:
+			self.tmp_filepath = self.filepath + "." + str(os.getpid()) + ".tmp"
+			self.file = open(self.tmp_filepath, 'w', buffering=LOG_BUFFER_SIZE)
+			open_loggers.append(self)
+			count_written()
+			if not structured:
+				self.file.write(self.get_start_str() + "\n")
+				for log_level_file in self.log_file[1:]:
+					self.spools[log_level_file] = tempfile.SpooledTemporaryFile(max_size=LOG_SPOOL_SIZE, mode='w+')
 		print(self.get_start_str())
 
 	
@@ -95,9 +480,22 @@ class Logger:
 		output = output + "----------------------------"
 		return output
 	
+	def enabled(self, log_level):
+		"""True if a message of this level goes to the console or the log file."""
+		return log_level in self.log_consol or (log_level in self.log_file and not self.file is None)
+
 	def log(self, log_level, msg):
+		self.counts[log_level] += 1
+		if not self.enabled(log_level):
+			return
 		msg_str = self.get_message_str(log_level, msg)
-		self.messages[log_level].append(msg_str)
+		if log_level in self.log_file and not self.file is None:
+			if self.structured:
+				self.file.write(json.dumps({"title": self.title, "level": log_level.value, "message": msg}) + "\n")
+			elif log_level in self.spools:
+				self.spools[log_level].write(msg_str + "\n")
+			else:
+				self.file.write(msg_str + "\n")
 		if log_level in self.log_consol:
 			print(msg_str)
 		
@@ -105,17 +503,40 @@ class Logger:
 		output = "----------------------------\n"
 		output = output + "Finished (" + self.title + ") - "
 		for log_level_file in self.log_file:
-			output = output + log_level_file.value + "s: " + str(len(self.messages[log_level_file])) + " "
+			output = output + log_level_file.value + "s: " + str(self.counts[log_level_file]) + " "
 		output = output + "\n"
 		output = output + "============================"
 		print(output)
-		if not self.filepath is None:
-			with open(self.filepath, 'w') as file:
-				file.write(self.get_start_str() + "\n")
-				for log_level_file in self.log_file:
-					for line in self.messages[log_level_file]:
-						file.write(line + "\n")
-				file.write(output)
+		if not self.file is None:
+			if self.structured:
+				summary = {log_level_file.value: self.counts[log_level_file] for log_level_file in self.log_file}
+				self.file.write(json.dumps({"title": self.title, "summary": summary}) + "\n")
+			else:
+				for log_level_file in self.log_file[1:]:
+					spool = self.spools.pop(log_level_file)
+					spool.seek(0)
+					shutil.copyfileobj(spool, self.file)
+					spool.close()
+				self.file.write(output)
+			self.file.close()
+			self.file = None
+			os.replace(self.tmp_filepath, self.filepath)
+			open_loggers.remove(self)
+
+	def discard(self):
+		"""Drop the unfinished log file, the previous one stays in place."""
+		if self.file is None:
+			return
+		for spool in self.spools.values():
+			spool.close()
+		self.spools = {}
+		self.file.close()
+		self.file = None
+		try:
+			os.remove(self.tmp_filepath)
+		except OSError:
+			pass
+		open_loggers.remove(self)
 		
 	def get_message_str(self, log_level, msg):
 		msg_str = "[" + log_level.value + "]: " + msg
@@ -124,44 +545,68 @@ class Logger:
 		return msg_str
 
 ## class Hotkey modified : object structure now allows OtherSeeds
+## values are kept in a list indexed like the seeds, shared seed -> index dicts
+seed_indexes = {}
+
+class Model(dict):
+	"""section -> key -> Hotkey. caches holds what the checks derive from the
+	values (value matrix, hint engines, key indexes), emptied by set_value()."""
+	__slots__ = ('caches',)
+
+	def __init__(self, *args, **kwargs):
+		dict.__init__(self, *args, **kwargs)
+		self.caches = {}
+
 class Hotkey:
+	__slots__ = ('name', 'section', 'default', 'copyOf', 'root', 'seed_index', 'values', 'alternates', 'caches')
 
 	def __init__(self, seeds, name, section, default=None, copyOf=None):
 		self.name = name
 		self.section = section
-		self.key = {}
 		self.default = default
 		self.copyOf = copyOf
+		# end of the copyOf chain, set by link_inheritance()
+		self.root = None
+		seeds = tuple(seeds)
+		if not seeds in seed_indexes:
+			seed_indexes[seeds] = {seed: index for index, seed in enumerate(seeds)}
+		self.seed_index = seed_indexes[seeds]
 		# init to None for all seed
-		for seed in seeds:
-			self.key[seed] = None
+		self.values = [None] * len(seeds)
+		# split values, filled on first get_alternates()
+		self.alternates = [None] * len(seeds)
+		# caches of the model, set by build_model()
+		self.caches = None
 
 	def set_value(self, seed, value):
-		self.key[seed] = value
+		index = self.seed_index[seed]
+		self.values[index] = value
+		self.alternates[index] = None
+		if self.caches:
+			self.caches.clear()
 
 	def get_raw_value(self, seed):
-		return self.key[seed]
+		return self.values[self.seed_index[seed]]
 
 	def get_value(self, seed):
-		value = self.get_raw_value(seed)
+		value = self.values[self.seed_index[seed]]
 		if value is None:
 			value = self.default
 		return value
 
+	def get_alternates(self, seed):
+		"""Tuple of the (interned) alternates of the value in a seed."""
+		index = self.seed_index[seed]
+		alternates = self.alternates[index]
+		if alternates is None:
+			alternates = tuple(sys.intern(alternate) for alternate in str(self.get_value(seed)).split(","))
+			self.alternates[index] = alternates
+		return alternates
+
 	def get_values_id(self):
 		values = ""
-		for seed in self.key:
-			value = self.get_value(seed)
-			first = True
-			alternates = value.split(",")
-			alternates.sort()
-			for alternate in alternates:
-				if first:
-					value = alternate
-					first = False
-				else:
-					value = value + "," + alternate
-			values = values + seed.value + ":" + value + "\n"
+		for seed in self.seed_index:
+			values = values + seed.value + ":" + ",".join(sorted(self.get_alternates(seed))) + "\n"
 		return values
 
 def init_seed_hotkeyfile_parser():
@@ -169,13 +614,13 @@ def init_seed_hotkeyfile_parser():
 	allSeeds = []
 	for race in Races:
 		hotkeyfile_parser = ConfigParser()
-		hotkeyfile_parser.read(create_filepath( prefix + thecore_tag(race, Sides.Left, Sizes.Medium) ) )
+		read_ini(hotkeyfile_parser, create_filepath( prefix + thecore_tag(race, Sides.Left, Sizes.Medium) ) )
 		if len(hotkeyfile_parser.sections()) > 0:
 			hotkeyfile_parsers[race] = hotkeyfile_parser
 			allSeeds.append(race)
 	for seed in OtherSeeds:
 		hotkeyfile_parser = ConfigParser()
-		hotkeyfile_parser.read(create_filepath( seed.value ) )
+		read_ini(hotkeyfile_parser, create_filepath( seed.value ) )
 		if len(hotkeyfile_parser.sections()) > 0:
 			hotkeyfile_parsers[seed] = hotkeyfile_parser
 			allSeeds.append(seed)
@@ -191,50 +636,61 @@ def create_filepath(string, directory=None):
 		filepath = directory + "/" + filename
 	return filepath
 
+@timed("new_keys_from_seed_hotkeys")
 def new_keys_from_seed_hotkeys(default_parser,hotkeyfile_parsers):
+	"""Add the keys of the seed layouts missing in Defaults.ini, with an empty
+	default. Defaults.ini is only written (atomically) if there are any."""
 	logger = Logger("Search for new Keys in seed layouts", log_consol=[LogLevel.Info], log_file=[])
+	known_keys = {section: set(default_parser.options(section)) for section in default_parser.sections()}
+	new_keys = False
 	for seed in hotkeyfile_parsers:
 		for section in hotkeyfile_parsers[seed].sections():
-			for item in hotkeyfile_parsers[seed].items(section):
-				key = item[0]
-				if not default_parser.has_option(section, key):
+			if not section in known_keys:
+				default_parser.add_section(section)
+				known_keys[section] = set()
+			for key in hotkeyfile_parsers[seed].options(section):
+				if not key in known_keys[section]:
 					default_parser.set(section, key, "")
+					known_keys[section].add(key)
+					new_keys = True
 					logger.log(LogLevel.Info, "New key found " + key + " added to " + default_filepath + " please add a default value")
-	with open(default_filepath, 'w') as myfile:
-		default_parser.write(myfile)
-	order(default_filepath)
-	default_parser.read(default_filepath)
+	if new_keys:
+		write_ordered(parser_to_dict(default_parser), default_filepath, atomic=True)
 	logger.finish()
 	return default_parser
 
-def order(filepath):
-	read_parser = ConfigParser()
-	read_parser.read(filepath)
-
+def parser_to_dict(parser):
 	dicti = {}
-	for section in read_parser.sections():
-		items = read_parser.items(section)
-		items.sort()
-		dicti[section] = items
-
-	open(filepath, 'w').close()  # clear file
-
-	write_parser = ConfigParser()  # on other parser just for the safty
-	write_parser.read(filepath)
-	write_parser.add_section("Settings")
-	write_parser.add_section("Hotkeys")
-	write_parser.add_section("Commands")
-
-	for section in dicti.keys():
-		if not write_parser.has_section(section):
-			write_parser.add_section(section)
-		items = dicti.get(section)
-		for item in items:
-			write_parser.set(section, item[0], item[1])
-
-	with open(filepath, 'w') as myfile:
-		write_parser.write(myfile)
+	for section in parser.sections():
+		dicti[section] = dict(parser.items(section))
+	return dicti
+
+def write_ordered(model, filepath, atomic=False):
+	"""Write a section -> key -> value dict in one pass, in the canonical order:
+	Settings, Hotkeys and Commands first, then any other section, keys sorted.
+	The output is the same as the order() of CorrectSeeds.py.
+	With atomic, the file is written aside and renamed over filepath."""
+	sections = ["Settings", "Hotkeys", "Commands"]
+	for section in model:
+		if not section in sections:
+			sections.append(section)
+	lines = []
+	for section in sections:
+		lines.append("[" + section + "]\n")
+		for key, value in sorted(model.get(section, {}).items()):
+			lines.append(key + "=" + str(value).replace("\n", "\n\t") + "\n")
+		lines.append("\n")
+	if atomic:
+		tmp_filepath = filepath + "." + str(os.getpid()) + ".tmp"
+		with open(tmp_filepath, 'w') as myfile:
+			myfile.write("".join(lines))
+		os.replace(tmp_filepath, filepath)
+	else:
+		with open(filepath, 'w') as myfile:
+			myfile.write("".join(lines))
+	count_written()
 
+@timed("check_defaults")
 def check_defaults(default_parser):
 	logger = Logger("Check defaults", "Defaults.log", log_consol=[LogLevel.Error], log_file=[LogLevel.Warn, LogLevel.Error])
 	for section in default_parser.sections():
@@ -259,52 +715,121 @@ def check_defaults(default_parser):
 						logger.log(LogLevel.Error, "no default " + key)
 	logger.finish()
 
+@timed("create_model")
 def create_model(seeds):
-	model = {}
+	return build_model(seeds, hotkeyfile_parsers)
+
+def build_model(seeds, seed_parsers):
+	"""Model of the keys of Defaults.ini with the values of the seed parsers."""
+	model = Model()
+	defaults = parser_to_dict(default_parser)
+	inherits = parser_to_dict(inherit_parser)
+	seed_values = [(seed, parser_to_dict(seed_parsers[seed])) for seed in seeds]
 	for section in default_parser.sections():
 		section_dict = {}
-		for key in default_parser.options(section):
-			hotkey = Hotkey(seeds, key, section, default=default_parser.get(section,key))
-			for seed in seeds:
-				if hotkeyfile_parsers[seed].has_option(section, key):
-					value = hotkeyfile_parsers[seed].get(section, key)
-					hotkey.set_value(seed, value)
-			if inherit_parser.has_option(section, key):
-				copyof = inherit_parser.get(section, key)
-				hotkey.copyOf = copyof
+		section_inherits = inherits.get(section, {})
+		section_seeds = [(seed, values.get(section, {})) for seed, values in seed_values]
+		for key, default in defaults[section].items():
+			hotkey = Hotkey(seeds, key, section, default=default)
+			hotkey.caches = model.caches
+			for seed, values in section_seeds:
+				if key in values:
+					hotkey.set_value(seed, values[key])
+			if key in section_inherits:
+				hotkey.copyOf = section_inherits[key]
 			section_dict[key] = hotkey
 		model[section] = section_dict
+	link_inheritance(model)
 	return model
 
-def generate(seeds,seed_model):
+def link_inheritance(model):
+	"""Resolve every copyOf chain of the model once, setting hotkey.root to the
+	hotkey it finally copies (itself without copyOf). Every hotkey met on a
+	chain gets its root too, so each chain is only walked once."""
+	for section in model:
+		for hotkey in model[section].values():
+			path = []
+			names = set()
+			while hotkey.root is None and hotkey.copyOf:
+				if hotkey.name in names:
+					cycle = [linked.name for linked in path[path.index(hotkey):]]
+					raise ValueError("copyOf cycle in section " + section + ": " + " -> ".join(cycle + [hotkey.name]))
+				path.append(hotkey)
+				names.add(hotkey.name)
+				hotkey = model[section][hotkey.copyOf]
+			if hotkey.root is None:
+				hotkey.root = hotkey
+			for linked in path:
+				linked.root = hotkey.root
+
+@timed("generate")
+def generate(seeds,seed_model,jobs=1,force=False):
 	logger = Logger("Generation", log_consol=[LogLevel.Info], log_file=[])
-	seed_models = init_models()
-	for seed in seeds:
-		if seed in Races:
-			logger.log(LogLevel.Info, "generate model for race: " + seed.value + " side: L size: M keyboardlayout: " + seed_layout)
-			seed_models[seed][Sides.Left][Sizes.Medium] = extract_race(seed_model, seed)
-			logger.log(LogLevel.Info, "generate model for race: " + seed.value + " side: R size: M keyboardlayout: " + seed_layout)
-			seed_models[seed][Sides.Right][Sizes.Medium] = convert_side(seed_models[seed][Sides.Left][Sizes.Medium], Sides.Right)
-			logger.log(LogLevel.Info, "generate model for race: " + seed.value + " side: L size: S keyboardlayout: " + seed_layout)
-			seed_models[seed][Sides.Left][Sizes.Small] = shift_left(seed_models[seed][Sides.Left][Sizes.Medium], Sides.Left)
-			logger.log(LogLevel.Info, "generate model for race: " + seed.value + " side: R size: S keyboardlayout: " + seed_layout)
-			seed_models[seed][Sides.Right][Sizes.Small] = shift_right(seed_models[seed][Sides.Right][Sizes.Medium], Sides.Right)
-			logger.log(LogLevel.Info, "generate model for race: " + seed.value + " side: L size: L keyboardlayout: " + seed_layout)
-			seed_models[seed][Sides.Left][Sizes.Large] = shift_right(seed_models[seed][Sides.Left][Sizes.Medium], Sides.Left)
-			logger.log(LogLevel.Info, "generate model for race: " + seed.value + " side: R size: L keyboardlayout: " + seed_layout)
-			seed_models[seed][Sides.Right][Sizes.Large] = shift_left(seed_models[seed][Sides.Right][Sizes.Medium], Sides.Right)
-		else:
-			seed_models[seed] = extract_race(seed_model, seed)
-	translate_and_create_files(seed_models, logger)
+	manifest = {}
+	if not force:
+		manifest = load_manifest()
+	executor = None
+	if jobs > 1:
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+	try:
+		for seed in seeds:
+			hashes = output_hashes(seed)
+			outputs = []
+			for output in seed_outputs(seed):
+				filepath = output[3]
+				if manifest.get(filepath) != hashes[filepath] or not os.path.isfile(filepath):
+					outputs.append(output)
+			if not outputs:
+				logger.log(LogLevel.Info, "seed " + seed.value + " is up to date")
+				continue
+			logger.log(LogLevel.Info, "generate model for seed: " + seed.value + " keyboardlayout: " + seed_layout)
+			model = extract_race(seed_model, seed)
+			translate_and_create_files(seed, model, logger, executor, outputs)
+			for output in outputs:
+				filepath = output[3]
+				manifest[filepath] = hashes[filepath]
+			save_manifest(manifest)
+	finally:
+		if executor is not None:
+			executor.shutdown()
 	logger.finish()
 
-def init_models():
-	models = {}
-	for race in Races:
-		models[race] = {}
-		for side in Sides:
-			models[race][side] = {}
-	return models
+def hash_sections(parser, sections):
+	"""Hash of the parsed content of some sections of an ini file."""
+	digest = hashlib.sha1()
+	for section in sections:
+		digest.update(("[" + section + "]\n").encode())
+		if parser.has_section(section):
+			for key, value in sorted(parser.items(section)):
+				digest.update((key + "=" + value + "\n").encode())
+	return digest.hexdigest()
+
+def output_hashes(seed):
+	"""Hash of every input of each file generated from a seed, by filepath."""
+	seed_hash = GENERATOR_VERSION
+	seed_hash += hash_sections(hotkeyfile_parsers[seed], hotkeyfile_parsers[seed].sections())
+	seed_hash += hash_sections(default_parser, default_parser.sections())
+	seed_hash += hash_sections(inherit_parser, inherit_parser.sections())
+	seed_hash += hash_sections(settings_parser, ['Filenames'])
+	hashes = {}
+	for layout, side, size, filepath in seed_outputs(seed):
+		digest = hashlib.sha1(seed_hash.encode())
+		digest.update(hash_sections(settings_parser, variant_map_sections(side, size)).encode())
+		digest.update(hash_sections(layout_parser, [layout]).encode())
+		hashes[filepath] = digest.hexdigest()
+	return hashes
+
+def load_manifest():
+	"""Input hashes of the files written by the previous runs, by filepath."""
+	try:
+		with open(manifest_filepath) as myfile:
+			return json.load(myfile)
+	except (OSError, ValueError):
+		return {}
+
+def save_manifest(manifest):
+	with open(manifest_filepath, 'w') as myfile:
+		json.dump(manifest, myfile, indent=0, sort_keys=True)
 
 def extract_race(seed_model, race):
 	model_dict = {}
@@ -321,16 +846,18 @@ def resolve_inherit(model, section, hotkey, race):
 	return value
 
 def resolve_copyof(model, section, hotkey):
-	while True:
-		if hotkey.copyOf:
-			hotkey = model[section][hotkey.copyOf]
-		else:
-			return hotkey
-
-def convert_side(seed_model, side):
-	return modify_model(seed_model, settings_parser, 'GlobalMaps', side)
-
-def modify_model(seed_model, parser, parser_section, side):
+	if hotkey.root is None:
+		link_inheritance(model)
+	return hotkey.root
+
+def compile_maps(parser):
+	"""Turn every section of a mapping ini into a plain key -> key dict."""
+	maps = {}
+	for section in parser.sections():
+		maps[section] = dict(parser.items(section))
+	return maps
+
+def modify_model(seed_model, key_map, altgr=False):
 	model_dict = {}
 	for section in seed_model:
 		model_dict[section] = {}
@@ -338,218 +865,369 @@ def modify_model(seed_model, parser, parser_section, side):
 			if section == "Settings":
 				newvalue = value
 			else:
-				newvalue = modify_value(value, parser, parser_section, side)
+				newvalue = modify_value(value, key_map, altgr)
 			model_dict[section][key] = newvalue
 	return model_dict
 
-def modify_value(org_value, parser, section, side):
-	altgr = "0"
-	if parser == layout_parser and side == Sides.Right:
-		altgr = layout_parser.get(section, "AltGr")
-
+def compose_maps(key_maps):
+	"""Compose key -> key dicts, applied in the given order, into one dict."""
+	composed = {}
+	for key_map in key_maps:
+		for key, value in composed.items():
+			composed[key] = key_map.get(value, value)
+		for key, value in key_map.items():
+			if not key in composed:
+				composed[key] = value
+	return composed
+
+def variant_map_sections(side, size):
+	"""MapDefinitions.ini sections turning the left medium seed into side/size."""
+	sections = []
+	if side == Sides.Right:
+		sections.append('GlobalMaps')
+	if size == Sizes.Small:
+		if side == Sides.Left:
+			sections.append(side.value + 'ShiftLeftMaps')
+		else:
+			sections.append(side.value + 'ShiftRightMaps')
+	elif size == Sizes.Large:
+		if side == Sides.Left:
+			sections.append(side.value + 'ShiftRightMaps')
+		else:
+			sections.append(side.value + 'ShiftLeftMaps')
+	return sections
+
+def variant_key_map(side, size, layout):
+	"""Single key -> key dict turning the left medium seed into side/size/layout.
+	Returns None when the seed is written untouched."""
+	key_maps = []
+	for section in variant_map_sections(side, size):
+		key_maps.append(settings_maps[section])
+	if layout != seed_layout:
+		key_maps.append(layout_maps[layout])
+	if not key_maps:
+		return None
+	return compose_maps(key_maps)
+
+def modify_value(org_value, key_map, altgr=False):
 	newalternates = []
 	for alternate in org_value.split(","):
 		keys = alternate.split("+")
-		newkeys = []
+		newkeys = [key_map.get(key, key) for key in keys]
 		# filter "Shift" only to make sure it is the same output as the old script
-		if altgr == "1" and keys.count("Alt") == 1 and keys.count("Control") == 0 and keys.count("Shift") == 0:
-			newkeys.append("Control")
-		for key in keys:
-			if parser.has_option(section, key):
-				newkey = parser.get(section, key)
-			else:
-				newkey = key
-			newkeys.append(newkey)
-		newalternate = ""
-		first = True
-		for newkey in newkeys:
-			if not first:
-				newalternate = newalternate + "+"
-			else:
-				first = False
+		if altgr and keys.count("Alt") == 1 and not "Control" in keys and not "Shift" in keys:
+			newkeys.insert(0, "Control")
+		# an unbound key drops everything mapped before it
+		start = 0
+		for index, newkey in enumerate(newkeys):
 			if not newkey:
-				newalternate = ""
-			else:
-				newalternate = newalternate + newkey
-		newalternates.append(newalternate)
-	first = True
-	newvalues = ""
-	for newalternate in newalternates:
-		if not newalternate:
-			continue
-		if not first:
-			newvalues = newvalues + ","
+				start = index + 1
+		if start:
+			newalternate = "".join("+" + newkey for newkey in newkeys[start:])
 		else:
-			first = False
-		newvalues = newvalues + newalternate
-	return newvalues
-
-def shift_left(seed_model, side):
-	shift_section = side.value + 'ShiftLeftMaps'
-	return shift(seed_model, shift_section, side)
-
-def shift_right(seed_model, side):
-	shift_section = side.value + 'ShiftRightMaps'
-	return shift(seed_model, shift_section, side)
-
-def shift(seed_model, shift_section, side):
-	return modify_model(seed_model, settings_parser, shift_section, side)
-
-def translate_and_create_files(models, logger):
-	layouts = layout_parser.sections()
-	for layout in layouts:
-		for seed in allSeeds:
+			newalternate = "+".join(newkeys)
+		if newalternate:
+			newalternates.append(newalternate)
+	return ",".join(newalternates)
+
+def variant_altgr(side, layout):
+	"""AltGr layouts turn Alt into Control+Alt on the right side; modifier
+	keys are never remapped so it is checked on the seed keys."""
+	return side == Sides.Right and layout != seed_layout and layout_maps[layout]["AltGr"] == "1"
+
+def seed_variants(seed):
+	"""(side, size, filename) of every file generated from a seed."""
+	if seed in Races:
+		for side in Sides:
+			for size in Sizes:
+				yield side, size, prefix + thecore_tag(seed, side, size)
+	else:
+		yield Sides.Left, Sizes.Medium, seed.value
+
+def seed_outputs(seed):
+	"""(layout, side, size, filepath) of every file generated from a seed."""
+	for layout in layout_parser.sections():
+		for side, size, filename in seed_variants(seed):
+			yield layout, side, size, create_filepath(filename, layout)
+
+def translate_and_create_files(seed, model, logger, executor=None, outputs=None):
+	"""Write the layout/variant files of a seed (all of them by default). With an
+	executor the files are translated and written by the worker processes; log
+	lines are still emitted in the same order as a sequential run."""
+	if outputs is None:
+		outputs = seed_outputs(seed)
+	pending = []
+	for layout, side, size, filepath in outputs:
+		if not os.path.isdir(layout):
+			os.makedirs(layout)
+		log_msg = None
+		if layout != seed_layout:
 			if seed in Races:
-				for side in Sides:
-					for size in Sizes:
-							if layout != seed_layout:
-								logger.log(LogLevel.Info, "translate seed: " + seed.value + " side: " + side.value + " size: " + size.value + " keyboardlayout: " + layout)
-								model = translate(models[seed][side][size], layout, side)
-							else:
-								model = models[seed][side][size]
-							filename = prefix + thecore_tag(seed, side, size)
-							create_file(model, filename, layout, logger)
+				log_msg = "translate seed: " + seed.value + " side: " + side.value + " size: " + size.value + " keyboardlayout: " + layout
 			else:
-				if layout != seed_layout:
-					logger.log(LogLevel.Info, "translate seed: " + seed.value + " keyboardlayout: " + layout)
-					model = translate(models[seed], layout, Sides.Left)
-				else:
-					model = models[seed]
-				create_file(model, seed.value, layout, logger)
-
-def translate(seed_model, layout, side):
-	return modify_model(seed_model, layout_parser, layout, side)
-
-def create_file(model, filename, layout, logger):
-	hotkeyfile_parser = ConfigParser()
-	for section in model:
-		if not hotkeyfile_parser.has_section(section):
-				hotkeyfile_parser.add_section(section)
-		for key, value in model[section].items():
-			hotkeyfile_parser.set(section, key, value)
-	if not os.path.isdir(layout):
-		os.makedirs(layout)
-	filepath = create_filepath(filename, layout)
-	hotkeyfile = open(filepath, 'w')
-	hotkeyfile_parser.write(hotkeyfile)
-	hotkeyfile.close()
-	order(filepath)
-	logger.log(LogLevel.Info, filepath + " created")
+				log_msg = "translate seed: " + seed.value + " keyboardlayout: " + layout
+		key_map = variant_key_map(side, size, layout)
+		altgr = variant_altgr(side, layout)
+		if executor is None:
+			if log_msg:
+				logger.log(LogLevel.Info, log_msg)
+			with stage("write " + layout):
+				create_file(model, key_map, altgr, filepath)
+			logger.log(LogLevel.Info, filepath + " created")
+		else:
+			pending.append((log_msg, layout, executor.submit(timed_call, "write " + layout, create_file, model, key_map, altgr, filepath)))
+	for log_msg, layout, future in pending:
+		if log_msg:
+			logger.log(LogLevel.Info, log_msg)
+		filepath, stats = future.result()
+		merge_stage("write " + layout, stats)
+		logger.log(LogLevel.Info, filepath + " created")
+
+def create_file(model, key_map, altgr, filepath):
+	if key_map is not None:
+		model = modify_model(model, key_map, altgr)
+	write_ordered(model, filepath)
 	return filepath
 
-def analyse(model):
-	## default checks
-	same_check(model)
-	conflict_check(model)
-	wrong_inherit(model)
-	## context dependent checks
-	CheckConsistency(model)
-	hotkey_command_check(model)
-	unbound_command_check(model)
-	## quality checks accross seeds
-	if debug_parser.getboolean("Settings","quality",fallback=True):
-		stable_regression_check(model)
-		suggest_inherit(model)
-		missing_conflict_check(model)
+def analyse(model, checks=None, jobs=1):
+	"""Run the given checks (names of CHECKS), by default all of them, the
+	quality checks only if enabled in Debug.ini. With jobs > 1 the checks
+	run in a pool of processes; the console output is printed in the order
+	of the checks and each check writes its own log file, as without jobs."""
+	global constraints
+	## Check model against constraints
+	if constraints is None:
+		constraints = getConstraints()
+	if checks is None:
+		checks = list(CHECKS)
+		if not debug_parser.getboolean("Settings","quality",fallback=True):
+			checks = [check for check in checks if not check in QUALITY_CHECKS]
+	if jobs > 1 and len(checks) > 1:
+		## write the conflict table cache before the workers read it
+		get_conflict_table()
+		with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(checks)), initializer=init_check_worker, initargs=(model, allSeeds, constraints, profile_dir)) as executor:
+			futures = [executor.submit(run_check, check) for check in checks]
+			for check, future in zip(checks, futures):
+				output, stats = future.result()
+				sys.stdout.write(output)
+				merge_stage("check " + check, stats)
+		return
+	for check in checks:
+		with stage("check " + check):
+			call_check(check, model)
+
+def call_check(check, model, *args):
+	"""Run a check; if it fails, the log files it did not finish are dropped."""
+	try:
+		CHECKS[check](model, *args)
+	finally:
+		for logger in list(open_loggers):
+			logger.discard()
+
+check_model = None
+
+def init_check_worker(model, seeds, check_constraints, check_profile_dir):
+	"""Set up a worker of analyse(): configuration of the working directory,
+	model, seeds, constraints and profiling of the parent process."""
+	global check_model, allSeeds, constraints, profile_dir
+	with contextlib.redirect_stdout(io.StringIO()):
+		load_config()
+	check_model = model
+	allSeeds = seeds
+	constraints = check_constraints
+	profile_dir = check_profile_dir
+	del stage_stack[:]
+
+def run_check(check):
+	"""Run a check in a worker of analyse(), return its console output and
+	the stats of its stage."""
+	output = io.StringIO()
+	with contextlib.redirect_stdout(output):
+		stats = timed_call("check " + check, call_check, check, check_model)[1]
+	if profile_dir is not None:
+		dump_profiles()
+	return output.getvalue(), stats
+
+CHECK_CACHE_VERSION = 1
+check_cache_dir = os.path.dirname(os.path.abspath(__file__))
+
+class CheckCache:
+	"""Findings (level, message) of the units of a check, the conflict cards
+	of a seed for instance, kept on disk under a hash of the inputs
+	of the unit: the findings of a unit whose inputs did not change since the
+	last run are replayed instead of evaluated again."""
+
+	def __init__(self, check, enabled=True):
+		self.filepath = os.path.join(check_cache_dir, '.CheckResults-' + check + '.cache')
+		self.enabled = enabled
+		self.results = {}
+		self.used_results = {}
+		if enabled:
+			cache = load_cache(self.filepath, CHECK_CACHE_VERSION)
+			if cache is not None:
+				self.results = cache[1]
+
+	def key(self, *inputs):
+		return hashlib.sha1("\0".join(inputs).encode()).digest()
+
+	def get(self, key):
+		"""Cached findings of a unit, None if unknown."""
+		findings = self.results.get(key) if self.enabled else None
+		if findings is not None:
+			self.used_results[key] = findings
+		return findings
+
+	def put(self, key, findings):
+		self.used_results[key] = findings
+
+	def replay(self, logger, findings):
+		for level, log_msg in findings:
+			logger.log(LogLevel(level), log_msg)
+
+	def save(self):
+		"""Write the results of the units of this run, nothing when they are
+		the ones that were loaded."""
+		if not self.enabled:
+			return
+		results = self.used_results
+		if results == self.results:
+			return
+		save_cache(self.filepath, (CHECK_CACHE_VERSION, results))
+		self.results = results
 
 def same_check(model):
 	logger = Logger("same check", "SameCheck.log", log_consol=[], log_file=[LogLevel.Error])
+	sections = sorted(model)
 	for seed in allSeeds:
 		for same_set in SAME_CHECKS:  # @UndefinedVariable
 			same_set.sort()
 			first_key = same_set[0]
-			for section in collections.OrderedDict(sorted(model.items())):
+			for section in sections:
 				if not first_key in model[section]:
 					continue
-				mismatched = False
-				value = model[section][first_key].get_value(seed)
-				for key in same_set:
-					if not model[section][key].get_value(seed) == value:
-						mismatched = True
-				if mismatched:
+				values = [model[section][key].get_value(seed) for key in same_set]
+				if values.count(values[0]) != len(values):
 					log_msg = "Mismatched values in seed: " + seed.value
-					for key in same_set:
-						log_msg = log_msg + "\n\t" + key + " = " + model[section][key].get_value(seed)
+					for key, value in zip(same_set, values):
+						log_msg = log_msg + "\n\t" + key + " = " + value
 					logger.log(LogLevel.Error, log_msg)
 	logger.finish()
 
-def conflict_check(model):
+def build_key_index(model, seeds):
+	"""Per seed index: hotkey name -> tuple of its key alternates (all sections)."""
+	key_index = {}
+	for seed in seeds:
+		seed_index = {}
+		for section in sorted(model):
+			for key, hotkey in model[section].items():
+				alternates = hotkey.get_alternates(seed)
+				if key in seed_index:
+					alternates = seed_index[key] + alternates
+				seed_index[key] = alternates
+		key_index[seed] = seed_index
+	return key_index
+
+def conflict_check(model, cards=None):
+	"""Check the conflict cards to check for keys used twice. With cards (the
+	cards of the changed commands in watch mode) the conflicts of these cards
+	are printed too; ConflictCheck.log is written for all of them, the other
+	cards being replayed from the results cache."""
 	logger = Logger("conflict check", "ConflictCheck.log", log_consol=[], log_file=[LogLevel.Error])
+	verbose = debug_parser.getboolean("Settings","verbose",fallback=False)
+	commands, table_cards = get_conflict_table()
+	cards_to_check = []
+	for commandcard_key, command_ids in sorted(table_cards):
+		if commandcard_key in constraints.cards_to_check:
+			cards_to_check.append((commandcard_key, set(command_ids)))
+	## the hints of verbose runs depend on commands out of the card
+	cache = CheckCache("conflict", enabled=not verbose)
+	key_index = build_key_index(model, allSeeds)
 	for seed in allSeeds:
-		for commandcard_key, conflict_set in collections.OrderedDict(sorted(CONFLICT_CHECKS.items())).items():  # @UndefinedVariable
-			if not(commandcard_key in constraints['ToCheck']['Conflicts']):
-				continue
-			conflict_set.sort()
-			count_hotkeys = {}
-			for section in model:
-				for key, hotkey in model[section].items():
-					if key in conflict_set:
-						values = hotkey.get_value(seed).split(",")
-						for value in values:
-							if not value:
-								continue
-							if not value in count_hotkeys:
-								count_hotkeys[value] = 1
-							else:
-								count_hotkeys[value] = count_hotkeys[value] + 1
-			
-			
-			for value, count in collections.OrderedDict(sorted(count_hotkeys.items())).items():
-				if count > 1:
+		seed_index = key_index[seed]
+		masks = None
+		for commandcard_key, command_ids in cards_to_check:
+			unit = cache.key(seed.value, commandcard_key, *[commands[command_id] + "=" + ",".join(seed_index.get(commands[command_id], ())) for command_id in sorted(command_ids)])
+			findings = cache.get(unit)
+			if findings is None:
+				if masks is None:
+					key_names, masks, duplicates = get_key_bits(commands, seed_index)
+				findings = []
+				occupied = 0
+				conflicts = 0
+				for command_id in command_ids:
+					conflicts |= (occupied & masks[command_id]) | duplicates[command_id]
+					occupied |= masks[command_id]
+				conflict_set = sorted(commands[command_id] for command_id in command_ids)
+				conflict_values = [key_names[index] for index in range(conflicts.bit_length()) if conflicts >> index & 1]
+				for value in sorted(conflict_values):
 					log_msg = "Conflict of hotkeys in seed: " + seed.value + " commandcard: " + commandcard_key
 					issue_keys = []
 					for key in conflict_set:
-						for section in collections.OrderedDict(sorted(model.items())):
-							if not key in model[section]:
-								continue
-							raw_values = model[section][key].get_value(seed)
-							values = raw_values.split(",")
-							values.sort()
-							issue = False
-							for issue_value in values:
-								if issue_value == value:
-									issue = True
-									issue_keys.append(key)
-							if issue:
-								log_msg + log_msg + "\n\t" + key + " = " + raw_values
-					if debug_parser.getboolean("Settings","verbose",fallback=False):
+						issue_keys += [key] * seed_index.get(key, ()).count(value)
+					if verbose:
 						log_msg += "\nCommand in conflict :"
 						hint=""
 						for issue_key in issue_keys:
 							log_msg += "\n- " + issue_key
-							tmp_hint = remapHint(issue_key, seed, log=True)
+							tmp_hint = remapHint(model, issue_key, seed, log=True)
 							if hint=="" or tmp_hint.count("\n")<hint.count("\n"):
 								hint=tmp_hint
 						log_msg += hint
-					logger.log(LogLevel.Error, log_msg)
+					findings.append((LogLevel.Error.value, log_msg))
+				cache.put(unit, findings)
+			cache.replay(logger, findings)
+			if cards is not None and commandcard_key in cards:
+				for level, log_msg in findings:
+					print(logger.get_message_str(LogLevel(level), log_msg))
+	cache.save()
 	logger.finish()
-				
+
+def get_key_bits(commands, seed_index):
+	"""Keys of a seed as bits: (key names, one int bitset of keys per command,
+	one bitset per command of the keys it has more than once)."""
+	key_names = []
+	key_bits = {}
+	masks = []
+	duplicates = []
+	for command in commands:
+		mask = 0
+		duplicate = 0
+		for value in seed_index.get(command, ()):
+			if not value:
+				continue
+			if not value in key_bits:
+				key_bits[value] = 1 << len(key_names)
+				key_names.append(value)
+			bit = key_bits[value]
+			if mask & bit:
+				duplicate |= bit
+			mask |= bit
+		masks.append(mask)
+		duplicates.append(duplicate)
+	return key_names, masks, duplicates
+
 def suggest_inherit(model):
 	logger = Logger("suggest inherit", "SuggestInheritance.log", log_consol=[], log_file=[LogLevel.Info])
+	matrix = get_value_matrix(model, allSeeds)
 	outputdict = {}
 	for section in model:
 		outputdict[section] = {}
-		for hotkey1 in model[section].values():
-			values_id = hotkey1.get_values_id()
-			for hotkey2 in model[section].values():
-				if hotkey1.name == hotkey2.name:
-					continue
-				equal = True
-				for seed in allSeeds:
-					value = hotkey1.get_value(seed)
-					value2 = hotkey2.get_value(seed)
-					value_set = set(str(value).split(","))
-					value2_set = set(str(value2).split(","))
-					if value_set != value2_set:
-						equal = False
-						break
-				if equal:
-					if not values_id in outputdict[section]:
-						outputdict[section][values_id] = {}
-					if not hotkey1.name in outputdict[section][values_id]:
-						outputdict[section][values_id][hotkey1.name] = hotkey1
-					if not hotkey2.name in outputdict[section][values_id]:
-						outputdict[section][values_id][hotkey2.name] = hotkey2
+		## group the hotkeys having the same set of alternates in every seed
+		groups = {}
+		for hotkey in model[section].values():
+			signature = matrix[section][hotkey.name]
+			if not signature in groups:
+				groups[signature] = []
+			groups[signature].append(hotkey)
+		for hotkeys in groups.values():
+			if len(hotkeys) < 2:
+				continue
+			for hotkey1 in hotkeys:
+				values_id = hotkey1.get_values_id()
+				if not values_id in outputdict[section]:
+					outputdict[section][values_id] = {}
+				for hotkey2 in hotkeys:
+					outputdict[section][values_id][hotkey2.name] = hotkey2
 
 	for section in collections.OrderedDict(sorted(outputdict.items())):
 		for values_id in collections.OrderedDict(sorted(outputdict[section].items())):
@@ -569,22 +1247,38 @@ def suggest_inherit(model):
 			logger.log(LogLevel.Info, log_msg)
 	logger.finish()
 
+def get_value_matrix(model, seeds):
+	"""section -> key -> tuple with, for each seed, the id of the set of
+	alternates of the key: keys with equal rows have the same alternates in
+	every seed. Built once per model and seed list, kept in the model caches
+	with the ids of the sets of alternates, shared by the matrices of a model."""
+	cache_key = ('value matrix', tuple(seeds))
+	if cache_key in model.caches:
+		return model.caches[cache_key]
+	alternate_set_ids = model.caches.setdefault('alternate set ids', {})
+	matrix = {}
+	for section in model:
+		matrix[section] = {}
+		for key, hotkey in model[section].items():
+			row = []
+			for seed in seeds:
+				alternates = frozenset(hotkey.get_alternates(seed))
+				if not alternates in alternate_set_ids:
+					alternate_set_ids[alternates] = len(alternate_set_ids)
+				row.append(alternate_set_ids[alternates])
+			matrix[section][key] = tuple(row)
+	model.caches[cache_key] = matrix
+	return matrix
+
 def wrong_inherit(model):
 	logger = Logger("wrong inherit", "WrongInheritance.log", log_consol=[], log_file=[LogLevel.Error,LogLevel.Warn])
+	matrix = get_value_matrix(model, allSeeds)
 	for section in collections.OrderedDict(sorted(model.items())):
 		for hotkey in collections.OrderedDict(sorted(model[section].items())).values():
 			if not hotkey.copyOf:
 				continue
 			hotkeycopyof = resolve_copyof(model, section, hotkey)
-			equal = True
-			for seed in allSeeds:
-				value = hotkey.get_value(seed)
-				copyofvalue = hotkeycopyof.get_value(seed)
-				value_set = set(str(value).split(","))
-				copyofvalue_set = set(str(copyofvalue).split(","))
-				if value_set != copyofvalue_set:
-					equal = False
-			if not equal:
+			if matrix[section][hotkey.name] != matrix[section][hotkeycopyof.name]:
 				log_msg = hotkey.name + " != " + hotkeycopyof.name + "\n"
 				log_lvl = LogLevel.Warn
 				for seed in allSeeds:
@@ -612,12 +1306,29 @@ def wrong_inherit(model):
 def hotkey_command_check(model):
 	logger = Logger("command conflicts with hotkeys", "HotkeyCommandCheck.log", log_consol=[], log_file=[LogLevel.Error])
 	for seed in allSeeds:
-		hotkey_list = getHotkeyList(seed,'Hotkeys')
-		for command in sorted(hotkeyfile_parsers[seed].options('Commands')):
-			for key in model['Commands'][command].get_value(seed).split(','):
-				if key in hotkey_list:
-					log_msg = key + " used for command "+ command +", in seed " + seed.value
-					logger.log(LogLevel.Error, log_msg)
+		command_keys = get_command_keys(model, seed)
+		## keys used by both a command and a hotkey of the seed
+		findings = []
+		for key in get_hotkey_index(model, seed) & command_keys.keys():
+			findings += command_keys[key]
+		for command, position, key in sorted(findings):
+			log_msg = key + " used for command "+ command +", in seed " + seed.value
+			logger.log(LogLevel.Error, log_msg)
+		## clashes added by the generated files, two keys mapped to the same one
+		clashed = set((command, position) for command, position, key in findings)
+		for layout, side, size, filepath in seed_outputs(seed):
+			key_map = variant_key_map(side, size, layout)
+			if key_map is None:
+				continue
+			altgr = variant_altgr(side, layout)
+			variant_keys = map_single_keys(command_keys, key_map, altgr)
+			variant_findings = []
+			for key in get_hotkey_index(model, seed, key_map, altgr) & variant_keys.keys():
+				for seed_key in variant_keys[key]:
+					variant_findings += [(command, position, key) for command, position, old_key in command_keys[seed_key] if not (command, position) in clashed]
+			for command, position, key in sorted(variant_findings):
+				log_msg = key + " used for command "+ command +", in " + filepath
+				logger.log(LogLevel.Error, log_msg)
 	logger.finish()
 
 def unbound_command_check(model):
@@ -625,11 +1336,11 @@ def unbound_command_check(model):
 	for seed in allSeeds:
 		## Find&Report context unbound command within CONFLICT_CHECKS
 		for command in sorted(hotkeyfile_parsers[seed].options('Commands')):
-			for key in model['Commands'][command].get_value(seed).split(','):
+			for key in model['Commands'][command].get_alternates(seed):
 				if key == '':
 					log_msg = ' unbound command ' + command +", in seed " + seed.value
 					if debug_parser.getboolean("Settings","verbose",fallback=False):
-						 log_msg += remapHint(command, seed, log=True)
+						 log_msg += remapHint(model, command, seed, log=True)
 					logger.log(LogLevel.Error, log_msg)
 	logger.finish()
 
@@ -637,13 +1348,13 @@ def missing_conflict_check(model):
 	logger = Logger("commands with no attached conflict", "MissingConflict.log", log_consol=[], log_file=[LogLevel.Error, LogLevel.Warn])
 	## check for missing conflicts, temperate if part of SAME_CHECKS or inheritance.ini
 	for command in default_parser.options('Commands'):
-		if not(command in constraints['CommandInfo']['HasConflict']):
+		if not(command in constraints.conflict_commands):
 			log_msg = command + " not related to a conflict"
 			level = LogLevel.Error
-			if command in constraints['CommandInfo']['HasSame']:
+			if command in constraints.same_commands:
 				log_msg += "\nbut is part of same check"
 				level = LogLevel.Warn
-			if command in constraints['CommandInfo']['HasInherit']:
+			if command in constraints.inherit_commands:
 				log_msg += "\nbut is inherited"
 				level = LogLevel.Warn
 			for seed in allSeeds:
@@ -651,141 +1362,295 @@ def missing_conflict_check(model):
 			logger.log(level, log_msg)
 	logger.finish()
 
+## contexts whose commands are compared to the stable seeds
+STABLE_CONTEXTS = ['LotV Multiplayer','HotS Multiplayer','libertymulti','swarmmulti','voidmulti']
+
 def stable_regression_check(model,stableDir='stable'):
 	logger = Logger("Regression against referenced seeds", "StableRegression.log", log_consol=[LogLevel.Info], log_file=[LogLevel.Error, LogLevel.Warn, LogLevel.Info])
 	pairlist = []
 	for race in Races:
 		if race in allSeeds:
-			filename = create_filepath( prefix + thecore_tag(race, Sides.Left, Sizes.Medium), 'stable')
+			filename = create_filepath( prefix + thecore_tag(race, Sides.Left, Sizes.Medium), stableDir)
 			if os.path.isfile(filename):
-				pairlist.append( (seed,filename) )
+				pairlist.append( (race,filename) )
 	for seed in OtherSeeds:
 		if seed in allSeeds:
-			filename = create_filepath( seed.value, 'stable')
+			filename = create_filepath( seed.value, stableDir)
 			if os.path.isfile(filename):
 				pairlist.append( (seed,filename) )
+	## the stable seeds, loaded once in a model of their own
+	stable_parsers = {}
+	for seed, filename in pairlist:
+		stable_parsers[seed] = ConfigParser()
+		read_ini(stable_parsers[seed], filename)
+	reference = build_model([seed for seed, filename in pairlist], stable_parsers)
+	commands_to_check = set()
+	for context in STABLE_CONTEXTS:
+		commands_to_check.update(constraints.context_commands.get(context, ()))
 	for seed, filename in pairlist:
 		log_msg = "seed '"+seed.value+"' got regression check against '"+filename+"'"
 		logger.log(LogLevel.Info, log_msg)
-		ref_parser = ConfigParser()
-		ref_parser.read(default_filepath)
-		ref_parser.read(filename)
-		for section in model.keys():
+		counts = collections.Counter()
+		for section, key, kind in stable_diff(model, reference, stable_parsers[seed], seed, commands_to_check):
+			counts[kind] += 1
+			if kind == 'unknown':
+				log_msg = "'" + key + "' of '" + filename + "' is not in " + default_filepath + ", in seed '" + seed.value + "'"
 			## Check Commands
-			if section == 'Commands':
-				commandToCheck={}
-				for context in ['LotV Multiplayer','HotS Multiplayer','libertymulti','swarmmulti','voidmulti']:
-					for command in constraints['CommandByContexts'][context]:
-						commandToCheck[command]=0
-				for command in sorted(commandToCheck):
-					if model['Commands'][command].get_value(seed) != ref_parser['Commands'][command]:
-						log_msg = "'" +model['Commands'][command].get_value(seed) + "' used in place of '" + ref_parser['Commands'][command] + "' for command '"+ command + "', in seed '" + seed.value + "'"
-						logger.log(LogLevel.Warn, log_msg)
+			elif section == 'Commands':
+				log_msg = "'" +model['Commands'][key].get_value(seed) + "' used in place of '" + reference['Commands'][key].get_value(seed) + "' for command '"+ key + "', in seed '" + seed.value + "'"
 			else:
-				for param in sorted(model[section].keys()):
-					if model[section][param].get_value(seed) != ref_parser[section][param]:
-						log_msg =  model[section][param].get_value(seed) + " used in place of " + ref_parser[section][param] + " for parameter "+ param +", in seed " + seed.value
-						logger.log(LogLevel.Error, log_msg)
+				log_msg =  model[section][key].get_value(seed) + " used in place of " + reference[section][key].get_value(seed) + " for parameter "+ key +", in seed " + seed.value
+			logger.log(LogLevel.Warn if section == 'Commands' else LogLevel.Error, log_msg)
+		log_msg = "seed '" + seed.value + "' against '" + filename + "': " + ", ".join(str(counts[kind]) + " " + kind for kind in ['changed', 'added', 'removed', 'unknown'])
+		logger.log(LogLevel.Info, log_msg)
 	logger.finish()
 
+def stable_diff(model, reference, stable_parser, seed, commands_to_check):
+	"""(section, key, kind) of every key whose value in the seed is not the one
+	of the stable seed, section by section, keys sorted. kind is 'changed' if
+	both bind the key, 'added' if only the seed does, 'removed' if only the
+	stable seed does, and 'unknown' for a key of the stable seed that is not
+	in Defaults.ini. Commands are limited to commands_to_check."""
+	for section in model:
+		if section == 'Commands':
+			keys = sorted(key for key in commands_to_check if key in model[section])
+		else:
+			keys = sorted(model[section])
+		for key in keys:
+			hotkey = model[section][key]
+			stable_hotkey = reference[section][key]
+			if hotkey.get_value(seed) == stable_hotkey.get_value(seed):
+				continue
+			if hotkey.get_raw_value(seed) is None:
+				yield section, key, 'removed'
+			elif stable_hotkey.get_raw_value(seed) is None:
+				yield section, key, 'added'
+			else:
+				yield section, key, 'changed'
+		if stable_parser.has_section(section):
+			for key in sorted(stable_parser.options(section)):
+				if not key in model[section] and (section != 'Commands' or key in commands_to_check):
+					yield section, key, 'unknown'
+
+CONSTRAINTS_CACHE_VERSION = 1
+constraints_cache_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.Constraints.cache')
+
+class Constraints:
+	"""Indexes of the conflict cards, same sets and inheritance:
+	command_cards     command -> conflict cards it is on (once per occurrence)
+	context_cards     context -> its conflict cards
+	context_commands  context -> set of the commands of its cards
+	command_contexts  command -> contexts of its cards
+	command_units     command -> (root, unit), first parts of its name, unit None if no '/'
+	conflict_commands, same_commands, inherit_commands: sets of commands
+	commands_to_check, cards_to_check: sets, the ignored contexts left out"""
+	FIELDS = ('command_cards', 'context_cards', 'context_commands', 'command_contexts', 'command_units',
+		'conflict_commands', 'same_commands', 'inherit_commands', 'commands_to_check', 'cards_to_check')
+
+	def __init__(self, fields):
+		for name in self.FIELDS:
+			setattr(self, name, fields[name])
+
+	def fields(self):
+		return {name: getattr(self, name) for name in self.FIELDS}
+
 def getConstraints():
-	## init the constraints dict
-	constraints = {}
-	constraints['CommandInfo'] = {}
-	constraints['ConflictByContexts'] = {}
-	constraints['CommandByContexts'] = {}
-	constraints['CommandConflicts'] = {}
-	constraints['CommandContexts'] = {}
-	constraints['ToCheck'] = {}
-	## sublevels init
-	constraints['CommandInfo']['HasSame'] = []
-	constraints['CommandInfo']['HasInherit'] = []
-	constraints['CommandInfo']['HasConflict'] = []
-	constraints['ToCheck']['Commands'] = []
-	constraints['ToCheck']['Conflicts'] = []
-	## Add 'HasSame' info
-	for same in SAME_CHECKS:
-		if not same in constraints['CommandInfo']['HasSame']:
-			constraints['CommandInfo']['HasSame'] += same
-	## Add 'HasInherit' info
-	constraints['CommandInfo']['HasInherit'] = inherit_parser.options('Commands')
-	## Create context/command/conflict keys
-	for conflict in CONFLICT_CHECKS:
-		context = conflict.split("/")[0]
-		constraints['CommandByContexts'][context]=[]
-		constraints['ConflictByContexts'][context]=[]
-		for command in CONFLICT_CHECKS[conflict]:
-			constraints['CommandConflicts'][command]=[]
-			constraints['CommandContexts'][command]=[]
-	## Conflict related constraints
-	for conflict in CONFLICT_CHECKS:
+	"""Constraints of the conflict cards, same sets and inheritance, read from
+	.Constraints.cache as long as their inputs are the same."""
+	ignored_contexts = []
+	if debug:
+		ignored_contexts = debug_parser.options("IgnoredContexts")
+	## keyed on the conflict table the constraints are built from
+	get_conflict_table()
+	digest = hashlib.sha1(conflict_table_hash.encode())
+	## the same sets in a canonical order, same_check() sorts them in place
+	same_checks = sorted(tuple(sorted(same_set)) for same_set in SAME_CHECKS)  # @UndefinedVariable
+	for inputs in [same_checks, inherit_parser.options('Commands'), default_parser.options('Commands'), ignored_contexts]:
+		digest.update(repr(inputs).encode())
+	inputs_hash = digest.hexdigest()
+	cache = load_cache(constraints_cache_filepath, CONSTRAINTS_CACHE_VERSION)
+	if cache is not None and cache[1] == inputs_hash:
+		return Constraints(cache[2])
+	constraints = build_constraints(ignored_contexts)
+	save_cache(constraints_cache_filepath, (CONSTRAINTS_CACHE_VERSION, inputs_hash, constraints.fields()))
+	return constraints
+
+def build_constraints(ignored_contexts):
+	"""Build the Constraints in one pass over the conflict cards."""
+	conflict_checks = get_conflict_checks()
+	command_cards = {}
+	context_cards = {}
+	context_commands = {}
+	command_contexts = {}
+	for conflict, commands in conflict_checks.items():
 		context = conflict.split("/")[0]
-		if not(conflict in constraints['ConflictByContexts'][context]):
-			constraints['ConflictByContexts'][context].append(conflict)
-		for command in CONFLICT_CHECKS[conflict]:
-			constraints['CommandConflicts'][command].append(conflict)
-			if not(context in constraints['CommandContexts'][command]):
-				constraints['CommandContexts'][command].append(context)
-			if not(command in constraints['CommandInfo']['HasConflict']):
-				constraints['CommandInfo']['HasConflict'].append(command)
-			if not(command in constraints['CommandByContexts'][context]):
-				constraints['CommandByContexts'][context].append(command)
+		context_cards.setdefault(context, []).append(conflict)
+		context_command_set = context_commands.setdefault(context, set())
+		for command in commands:
+			command_cards.setdefault(command, []).append(conflict)
+			command_contexts.setdefault(command, {})[context] = None
+			context_command_set.add(command)
+	command_units = {}
+	for command in list(default_parser.options('Commands')) + list(command_cards):
+		parts = command.split("/")
+		command_units[command] = (parts[0], parts[1] if len(parts) > 1 else None)
 	## ToCheck generation
-	for context in constraints['CommandByContexts']:
-		if debug:
-			if context in debug_parser.options("IgnoredContexts"):
-				print('INFO: Ignored context : ' + context)
+	commands_to_check = set()
+	cards_to_check = set()
+	for context in context_commands:
+		if context in ignored_contexts:
+			print('INFO: Ignored context : ' + context)
+			continue
+		commands_to_check.update(context_commands[context])
+		cards_to_check.update(context_cards[context])
+	## produce info
+	print('Commands to check : ' + str(len(commands_to_check)))
+	print('Conflicts to check : ' + str(len(cards_to_check)))
+	fields = {}
+	fields['command_cards'] = {command: tuple(cards) for command, cards in command_cards.items()}
+	fields['context_cards'] = {context: tuple(cards) for context, cards in context_cards.items()}
+	fields['context_commands'] = {context: frozenset(commands) for context, commands in context_commands.items()}
+	fields['command_contexts'] = {command: tuple(contexts) for command, contexts in command_contexts.items()}
+	fields['command_units'] = command_units
+	fields['conflict_commands'] = frozenset(command_cards)
+	fields['same_commands'] = frozenset(command for same in SAME_CHECKS for command in same)  # @UndefinedVariable
+	fields['inherit_commands'] = frozenset(inherit_parser.options('Commands'))
+	fields['commands_to_check'] = frozenset(commands_to_check)
+	fields['cards_to_check'] = frozenset(cards_to_check)
+	return Constraints(fields)
+
+IGNORED_HOTKEYS = ('TargetChoose', 'TargetCancel')
+
+def bare_hotkeys(values):
+	"""Ordered dict of the single keys (no modifier) in hotkey values."""
+	return dict.fromkeys(key for value in values for key in value.split(',') if key != '' and key.count('+') == 0)
+
+## Hotkeys section index, one per seed file: the single keys the seed binds to
+## a global hotkey, read from the seed file itself so that keys missing from
+## Defaults.ini count too. Built on first use and kept in the model caches
+## until the seed file is read again; the index of a generated file is the
+## seed index through the key map of the file.
+def get_hotkey_index(model, seed, key_map=None, altgr=False):
+	"""Frozenset of the single keys of the Hotkeys section of a seed, the
+	ignored hotkeys left out. With the key_map (and altgr) of a generated
+	file, the single keys of that file."""
+	cache_key = ('hotkey index', seed)
+	parser = hotkeyfile_parsers[seed]
+	if not (cache_key in model.caches and model.caches[cache_key][0] is parser):
+		values = [parser.get('Hotkeys', command) for command in parser.options('Hotkeys') if not command in IGNORED_HOTKEYS]
+		model.caches[cache_key] = (parser, frozenset(bare_hotkeys(values)))
+	hotkey_index = model.caches[cache_key][1]
+	if key_map:
+		hotkey_index = frozenset(bare_hotkeys(modify_value(key, key_map, altgr) for key in hotkey_index))
+	return hotkey_index
+
+def get_command_keys(model, seed):
+	"""key -> [(command, position of the key in its value, key)] of the
+	commands set in the seed, built once per model and seed."""
+	cache_key = ('command keys', seed)
+	if not cache_key in model.caches:
+		command_keys = {}
+		for command, hotkey in model['Commands'].items():
+			if hotkey.get_raw_value(seed) is None:
 				continue
-		for command in constraints['CommandByContexts'][context]:
-			if not(command in constraints['ToCheck']['Commands']):
-				constraints['ToCheck']['Commands'].append(command)
-		for conflict in constraints['ConflictByContexts'][context]:
-			if not(conflict in constraints['ToCheck']['Conflicts']):
-				constraints['ToCheck']['Conflicts'].append(conflict)
-	## Sort ToCheck entries + produce info
-	for entry in sorted(constraints['ToCheck']):
-		constraints['ToCheck'][entry].sort()
-		print(entry + ' to check : ' + str(len(constraints['ToCheck'][entry])))
-	## Return constraints dict
-	return constraints
-
-def getHotkeyList(seed,section,ignoredCommands=['TargetChoose','TargetCancel']):
-	hotkey_list = []
-	for command in hotkeyfile_parsers[seed].options(section):
-		if not command in ignoredCommands:
-			for hotkey in  hotkeyfile_parsers[seed].get(section,command).split(','):
-				if hotkey != '' and hotkey.count('+') == 0 and not(hotkey in hotkey_list):
-					hotkey_list.append(hotkey)
-	return hotkey_list
-
-def remapHint(command, seed, log=False):
-	if debug_parser.getboolean("Settings","verydetail",fallback=not(log)):
-		hint = 'Remap hints for command: ' + command + '\n'
-	else:
-		hint = ''
-	listForbiddenKeys = []
-	for conflict in sorted(constraints['ToCheck']['Conflicts']):
-		if command in sorted(CONFLICT_CHECKS[conflict]):
-			if debug_parser.getboolean("Settings","verydetail",fallback=not(log)):
-				hint += "-CONFLICT- " + conflict + '\n'
-			for otherCommand in sorted(CONFLICT_CHECKS[conflict]):
-				keys = model['Commands'][otherCommand].get_value(seed)
-				if debug_parser.getboolean("Settings","verydetail",fallback=not(log)):
-					hint += keys + "\t" + otherCommand + '\n'
-				for key in keys.split(','):
-					if not(key in listForbiddenKeys):
-						listForbiddenKeys.append(key)
-	hint += 'List of forbidden keys:\n'
-	hint += str(listForbiddenKeys)
+			for position, key in enumerate(hotkey.get_alternates(seed)):
+				command_keys.setdefault(key, []).append((command, position, key))
+		model.caches[cache_key] = command_keys
+	return model.caches[cache_key]
+
+def map_single_keys(keys, key_map, altgr=False):
+	"""key in a generated file -> keys of the seed it comes from, for the
+	single keys (no modifier) of keys."""
+	mapped = {}
+	for key in keys:
+		if key.count('+') == 0:
+			mapped.setdefault(modify_value(key, key_map, altgr), []).append(key)
+	return mapped
+
+## remapHint engine, one per model, constraints and seed: keys of the checked
+## conflict cards, and for each command the keys it may not use (the keys of
+## the commands sharing a checked card with it), built on first use and kept
+## in the model caches.
+def get_hint_engine(model, seed):
+	cache_key = ('hint engine', seed)
+	engine = model.caches.get(cache_key)
+	if engine is not None and engine['constraints'] is constraints:
+		return engine
+	engine = {'model': model, 'seed': seed, 'constraints': constraints, 'conflicts': constraints.cards_to_check, 'cards': {}, 'forbidden': {}, 'hints': {}, 'keys': None}
+	model.caches[cache_key] = engine
+	return engine
+
+def get_card_keys(engine, conflict):
+	"""(keys of the card in order of its sorted commands, verydetail lines)."""
+	if not conflict in engine['cards']:
+		model, seed = engine['model'], engine['seed']
+		keys = {}
+		detail = "-CONFLICT- " + conflict + '\n'
+		for otherCommand in sorted(get_conflict_checks()[conflict]):
+			detail += model['Commands'][otherCommand].get_value(seed) + "\t" + otherCommand + '\n'
+			keys.update(dict.fromkeys(model['Commands'][otherCommand].get_alternates(seed)))
+		engine['cards'][conflict] = (tuple(keys), detail)
+	return engine['cards'][conflict]
+
+def get_command_conflicts(engine, command):
+	return [conflict for conflict in sorted(constraints.command_cards.get(command, ())) if conflict in engine['conflicts']]
+
+def get_forbidden_keys(model, command, seed):
+	"""Keys used by the commands sharing a checked conflict card with command,
+	in order of the cards and commands."""
+	engine = get_hint_engine(model, seed)
+	if not command in engine['forbidden']:
+		keys = {}
+		for conflict in get_command_conflicts(engine, command):
+			keys.update(dict.fromkeys(get_card_keys(engine, conflict)[0]))
+		engine['forbidden'][command] = tuple(keys)
+	return engine['forbidden'][command]
+
+def get_available_keys(model, command, seed):
+	"""Keys command could use: the keys of the keyboard (remapped by
+	MapDefinitions.ini) and the keys bound in the seed, the forbidden ones
+	left out. Free keys are listed as well as keys of unrelated commands."""
+	engine = get_hint_engine(model, seed)
+	if engine['keys'] is None:
+		keys = set()
+		for section, key_map in settings_maps.items():
+			if section != 'Filenames':
+				keys.update(key_map)
+				keys.update(key_map.values())
+		for hotkey in model['Commands'].values():
+			keys.update(hotkey.get_alternates(seed))
+		keys.discard("")
+		engine['keys'] = tuple(sorted(keys))
+	forbidden = set(get_forbidden_keys(model, command, seed))
+	return [key for key in engine['keys'] if not key in forbidden]
+
+def remapHint(model, command, seed, log=False):
+	verydetail = debug_parser.getboolean("Settings","verydetail",fallback=not(log))
+	engine = get_hint_engine(model, seed)
+	if not (command, verydetail) in engine['hints']:
+		if verydetail:
+			hint = 'Remap hints for command: ' + command + '\n'
+			for conflict in get_command_conflicts(engine, command):
+				hint += get_card_keys(engine, conflict)[1]
+		else:
+			hint = ''
+		hint += 'List of forbidden keys:\n'
+		hint += str(list(get_forbidden_keys(model, command, seed)))
+		engine['hints'][(command, verydetail)] = hint
+	hint = engine['hints'][(command, verydetail)]
 	if log:
 		return("\n"+hint)
 	else:
 		print(hint)
+		print('List of available keys:\n' + str(get_available_keys(model, command, seed)))
 
 ###########################################
 # Section related to Meta .SC2Hotkeys
 ###########################################
 
+## units whose commands do not share the keys of their command root
+CONSISTENCY_EXCEPTIONS = frozenset(['VoidRift','VoidRiftUnselectable','SuperWarpGate','VoidThrasher','VoidThrasherWalker','Epilogue02VoidRift','SJMercStarport','MercCompound','PrimalTownHallUprooted','PrimalTownHall','MutaliskViper','Bunker','Colossus','ColossusPurifier'])
+
 def CheckConsistency(model, write=False):
 	logger = Logger("Check key reuse over common CommandRoot", "CommandRootConsistency.log", log_file=[LogLevel.Error])
 	for seed in allSeeds:
@@ -801,16 +1666,14 @@ def CheckConsistency(model, write=False):
 		tmp_dict2['keys'] = {}
 		tmp_dict2['ok'] = {}
 		for command in sorted(model['Commands']):
-			command_list = command.split('/')
-			if len(command_list) > 1:
-				if command_list[1] in ['VoidRift','VoidRiftUnselectable','SuperWarpGate','VoidThrasher','VoidThrasherWalker','Epilogue02VoidRift','SJMercStarport','MercCompound','PrimalTownHallUprooted','PrimalTownHall','MutaliskViper','Bunker','Colossus','ColossusPurifier']:
-					metaseed_parser.set('Commands',command,model['Commands'][command].get_value(seed))
-					continue
-			command_root = command_list[0]
+			command_root, command_unit = constraints.command_units[command]
+			if command_unit in CONSISTENCY_EXCEPTIONS:
+				metaseed_parser.set('Commands',command,model['Commands'][command].get_value(seed))
+				continue
 			if not( command_root in tmp_dict2['ok'] ):
 				tmp_dict2['ok'][command_root] = True
 			if tmp_dict2['ok'][command_root] == True:
-				keys = model['Commands'][command].get_value(seed).split(',')
+				keys = model['Commands'][command].get_alternates(seed)
 				if not( command_root in tmp_dict2['keys'] ):
 					tmp_dict2['keys'][command_root] = keys
 					metaseed_parser.set('Commands',command_root,model['Commands'][command].get_value(seed))
@@ -855,11 +1718,149 @@ def CheckConsistency(model, write=False):
 
 
 
+####################################################################################
+## Checks run by analyse(), in this order
+####################################################################################
+
+CHECKS = collections.OrderedDict([
+	## default checks
+	("same", same_check),
+	("conflict", conflict_check),
+	("wrong-inherit", wrong_inherit),
+	## context dependent checks
+	("consistency", CheckConsistency),
+	("hotkey-command", hotkey_command_check),
+	("unbound-command", unbound_command_check),
+	## quality checks accross seeds
+	("stable-regression", stable_regression_check),
+	("suggest-inherit", suggest_inherit),
+	("missing-conflict", missing_conflict_check),
+])
+QUALITY_CHECKS = ["stable-regression", "suggest-inherit", "missing-conflict"]
+
+####################################################################################
+## Watch mode
+####################################################################################
+
+## sections of the seeds read by a check, all sections if not listed
+CHECK_SECTIONS = {"conflict": ["Commands"], "unbound-command": ["Commands"], "missing-conflict": ["Commands"]}
+
+def watch(checks=None, interval=0.5):
+	"""Run the checks, then poll the seed and configuration files and run them
+	again on every save, until interrupted. A saved seed file only updates its
+	values in the model, and re-runs the checks reading the changed sections,
+	the conflicts of the cards of the changed commands being printed. Any other
+	file reloads everything."""
+	model = watch_load()
+	analyse(model, checks)
+	mtimes = watched_mtimes()
+	print("watching " + str(len(mtimes)) + " files, Ctrl+C to stop")
+	try:
+		while True:
+			time.sleep(interval)
+			new_mtimes = watched_mtimes()
+			changed_files = [filepath for filepath in new_mtimes if new_mtimes[filepath] != mtimes.get(filepath)]
+			mtimes = new_mtimes
+			if not changed_files:
+				continue
+			start = time.perf_counter()
+			seeds = watched_seeds()
+			changes = []
+			for filepath in changed_files:
+				print(filepath + " changed")
+				if seeds.get(filepath) is None:
+					changes = None
+					break
+				changes += reload_seed(model, seeds[filepath], filepath)
+			if changes is None or [key for section, key in changes if not key in model.get(section, {})]:
+				model = watch_load()
+				## Defaults.ini may just have been updated with new keys
+				mtimes = watched_mtimes()
+				analyse(model, checks)
+			else:
+				analyse_changes(model, changes, checks)
+			print("analysed in " + str(int((time.perf_counter() - start) * 1000)) + " ms")
+	except KeyboardInterrupt:
+		pass
+
+def watch_load():
+	"""(Re)load the configuration and the model of the selected seeds."""
+	global constraints
+	load_config()
+	update_defaults()
+	model = create_model(select_seeds())
+	constraints = getConstraints()
+	return model
+
+def watched_seeds():
+	"""filepath -> seed of the files of the selected seeds."""
+	seeds = {}
+	for seed in allSeeds:
+		if seed in Races:
+			seeds[create_filepath(prefix + thecore_tag(seed, Sides.Left, Sizes.Medium))] = seed
+		else:
+			seeds[create_filepath(seed.value)] = seed
+	return seeds
+
+def watched_mtimes():
+	filepaths = list(watched_seeds())
+	filepaths += ['Debug.ini', 'MapDefinitions.ini', 'KeyboardLayouts.ini', default_filepath, ddefault_filepath, inherit_filepath, conflict_checks_filepath]
+	if os.path.isdir('stable'):
+		filepaths += [os.path.join('stable', filename) for filename in sorted(os.listdir('stable'))]
+	mtimes = {}
+	for filepath in filepaths:
+		try:
+			mtimes[filepath] = os.stat(filepath).st_mtime_ns
+		except OSError:
+			mtimes[filepath] = None
+	return mtimes
+
+def reload_seed(model, seed, filepath):
+	"""Read a seed file again and set its new values in the model, return the
+	changed (section, key)."""
+	parser = ConfigParser()
+	read_ini(parser, filepath)
+	old_values = parser_to_dict(hotkeyfile_parsers[seed])
+	new_values = parser_to_dict(parser)
+	changes = []
+	for section in sorted(set(old_values) | set(new_values)):
+		old_section = old_values.get(section, {})
+		new_section = new_values.get(section, {})
+		for key in sorted(set(old_section) | set(new_section)):
+			if old_section.get(key) != new_section.get(key):
+				changes.append((section, key))
+				if key in model.get(section, {}):
+					model[section][key].set_value(seed, new_section.get(key))
+	hotkeyfile_parsers[seed] = parser
+	return changes
+
+def analyse_changes(model, changes, checks=None):
+	"""Run the checks reading the changed sections, the conflict check printing
+	the conflicts of the cards of the changed commands."""
+	if checks is None:
+		checks = list(CHECKS)
+		if not debug_parser.getboolean("Settings","quality",fallback=True):
+			checks = [check for check in checks if not check in QUALITY_CHECKS]
+	sections = set(section for section, key in changes)
+	commands = set(key for section, key in changes if section == 'Commands')
+	print(str(len(changes)) + " changed keys")
+	for check in checks:
+		if not sections.intersection(CHECK_SECTIONS.get(check, sections)):
+			continue
+		with stage("check " + check):
+			if check == "conflict":
+				cards = set()
+				for command in commands:
+					cards.update(constraints.command_cards.get(command, ()))
+				call_check(check, model, cards)
+			else:
+				call_check(check, model)
+
 ####################################################################################
 ## MAIN
 ####################################################################################
 
-print("""
+BANNER = """
   ________         ______
  /_  __/ /_  ___  / ____/___  ________
   / / / __ \/ _ \/ /   / __ \/ ___/ _ \\
@@ -870,49 +1871,66 @@ print("""
  / /   / __ \/ __ \ | / / _ \/ ___/ __/ _ \/ ___/
 / /___/ /_/ / / / / |/ /  __/ /  / /_/  __/ /
 \____/\____/_/ /_/|___/\___/_/   \__/\___/_/
-""")
-
-# Read the settings
-settings_parser = ConfigParser()
-settings_parser.read('MapDefinitions.ini')
-prefix = settings_parser.get("Filenames", "Prefix")
-suffix = settings_parser.get("Filenames", "Suffix")
-seed_layout = settings_parser.get("Filenames", "Seed_files_folder")
-
-layout_parser = ConfigParser()
-layout_parser.read('KeyboardLayouts.ini')
-
-default_filepath = 'Defaults.ini'
-default_parser = ConfigParser()
-default_parser.read(default_filepath)
-
-ddefault_filepath = 'DifferentDefault.ini'
-ddefault_parser = ConfigParser()
-ddefault_parser.read(ddefault_filepath)
-
-inherit_filepath = 'Inheritance.ini'
-inherit_parser = ConfigParser()
-inherit_parser.read(inherit_filepath)
-
-## Consider all existing seeds for defaults handling/checks
-hotkeyfile_parsers, allSeeds = init_seed_hotkeyfile_parser()
-if debug_parser.getboolean("Settings","update_default",fallback=True):
-	default_parser = new_keys_from_seed_hotkeys(default_parser,hotkeyfile_parsers)
-check_defaults(default_parser)
-
-## Possibly reduce seed list to be considered
-if not(debug_parser.getboolean("Settings","allseeds",fallback=True)):
-	allSeeds = []
-	for race in debug_parser.options("Races"):
-		allSeeds.append(Races[race])
-	for seed in debug_parser.options("OtherSeeds"):
-		allSeeds.append(OtherSeeds[seed])
-
-## Create model based on wanted seeds
-model = create_model(allSeeds)
-if debug_parser.getboolean("Settings","generate",fallback=True):
-	generate(allSeeds,model)
-
-## Check model against constraints
-constraints = getConstraints()
-analyse(model)
+"""
+
+def main(argv=None):
+	arg_parser = argparse.ArgumentParser(description="Generate TheCore layouts from the seed files and check them.")
+	arg_parser.add_argument("-j", "--jobs", type=int, default=1, help="number of processes used to write the layout files and to run the checks (default: 1)")
+	arg_parser.add_argument("-f", "--force", action="store_true", help="regenerate all layout files, even the up to date ones")
+	arg_parser.add_argument("--timing", action="store_true", help="print the wall time, calls, files written and peak RSS of each stage")
+	arg_parser.add_argument("--profile", metavar="DIR", help="dump a cProfile of each stage to DIR/<stage>.prof")
+	arg_parser.add_argument("--report", metavar="FILE", help="write the stage timings as a JSON report")
+	subparsers = arg_parser.add_subparsers(dest="command", metavar="command")
+	subparsers.add_parser("all", help="update the defaults, generate the layouts and run the checks (default)")
+	subparsers.add_parser("defaults", help="add the new seed keys to Defaults.ini and check the defaults")
+	subparsers.add_parser("generate", help="generate the layout files")
+	analyse_parser = subparsers.add_parser("analyse", help="run the checks")
+	analyse_parser.add_argument("-c", "--check", action="append", choices=list(CHECKS), help="check to run, can be repeated (default: all)")
+	subparsers.add_parser("conflicts", help="rebuild the conflict table cache from ConflictChecks.py")
+	watch_parser = subparsers.add_parser("watch", help="run the checks again each time a seed or .ini file is saved")
+	watch_parser.add_argument("-c", "--check", action="append", choices=list(CHECKS), help="check to run, can be repeated (default: all)")
+	watch_parser.add_argument("-i", "--interval", type=float, default=0.5, help="seconds between two polls of the files (default: 0.5)")
+	args = arg_parser.parse_args(argv)
+	global profile_dir
+	if args.profile:
+		if not os.path.isdir(args.profile):
+			os.makedirs(args.profile)
+		profile_dir = args.profile
+	start = time.perf_counter()
+	run_command(args.command or "all", args)
+	total_wall = time.perf_counter() - start
+	if profile_dir is not None:
+		dump_profiles()
+	if args.timing:
+		print(stage_summary())
+	if args.report:
+		write_stage_report(args.report, total_wall)
+
+def run_command(command, args):
+	if command == "conflicts":
+		table = write_conflict_cache()
+		print(conflict_cache_filepath + " written: " + str(len(table[3])) + " conflict cards, " + str(len(table[2])) + " commands")
+		return
+
+	print(BANNER)
+	if command == "watch":
+		watch(args.check, args.interval)
+		return
+	load_config()
+	if command in ["all", "defaults"]:
+		update_defaults()
+	if command == "defaults":
+		return
+
+	## Create model based on wanted seeds
+	seeds = select_seeds()
+	model = create_model(seeds)
+	if command == "generate" or (command == "all" and debug_parser.getboolean("Settings","generate",fallback=True)):
+		generate(seeds,model,args.jobs,args.force)
+	if command == "analyse":
+		analyse(model, args.check, args.jobs)
+	elif command == "all":
+		analyse(model, jobs=args.jobs)
+
+if __name__ == "__main__":
+	main()